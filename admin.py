@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
-from .models import Biography, Essay, Genre, Role
+from .models import Biography, Essay, Genre, Role, AnnotationWrite
 from .forms import AdminBiographyForm, EssayModelForm
 
 class BiographyAdmin(admin.ModelAdmin):
@@ -17,8 +17,20 @@ class GenreAdmin(admin.ModelAdmin):
 class RoleAdmin(admin.ModelAdmin):
     list_display = ['id', 'text', 'external_id']
 
+class AnnotationWriteAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'status', 'image_pid', 'anno_pid', 'title', 'username', 'attempts', 'created', 'last_error']
+    list_filter = ['status', 'kind']
+    actions = ['requeue']
+
+    def requeue(self, request, queryset):
+        #for interrupted posts, check the BDR doesn't have the annotation already first
+        from .outbox import requeue
+        self.message_user(request, '%s writes queued again' % requeue(queryset))
+    requeue.short_description = 'Queue the selected failed/interrupted writes again'
+
 admin.site.register(Biography, BiographyAdmin)
 admin.site.register(Essay, EssayAdmin)
 admin.site.register(Genre, GenreAdmin)
 admin.site.register(Role, GenreAdmin)
+admin.site.register(AnnotationWrite, AnnotationWriteAdmin)
 
@@ -18,6 +18,49 @@ BDR_AUTH_CODE = get_env_setting('ROME_BDR_AUTH_CODE')
 BDR_POST_URL = 'https://%s/api/items/v1/' % BDR_SERVER
 XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
 BDR_ANNOTATION_URL = 'https://%s/services/getMods/' % BDR_SERVER
+BDR_COLLECTION_ID = 621
+SEARCH_CHUNK_SIZE = int(os.environ.get('ROME_SEARCH_CHUNK_SIZE', 500)) #rows per request when paging through search results
+
+#connection pool & timeouts for requests to the BDR (see bdr_client.py)
+BDR_CONNECT_TIMEOUT = float(os.environ.get('ROME_BDR_CONNECT_TIMEOUT', 5))
+BDR_READ_TIMEOUT = float(os.environ.get('ROME_BDR_READ_TIMEOUT', 60))
+BDR_MAX_RETRIES = int(os.environ.get('ROME_BDR_MAX_RETRIES', 3))
+BDR_RETRY_BACKOFF = float(os.environ.get('ROME_BDR_RETRY_BACKOFF', 0.5))
+BDR_POOL_SIZE = int(os.environ.get('ROME_BDR_POOL_SIZE', 10))
+FETCH_WORKERS = int(os.environ.get('ROME_FETCH_WORKERS', 8)) #threads per process for parallel BDR requests (see concurrency.py)
+ANNOTATION_FETCH_DEADLINE = float(os.environ.get('ROME_ANNOTATION_FETCH_DEADLINE', 20)) #seconds to wait for all annotations on a page
+SEARCH_FETCH_DEADLINE = float(os.environ.get('ROME_SEARCH_FETCH_DEADLINE', 30)) #seconds to wait for a set of parallel searches
+ITEM_FETCH_DEADLINE = float(os.environ.get('ROME_ITEM_FETCH_DEADLINE', 30)) #seconds to wait for items fetched in parallel (e.g. a page & its book)
+DEBUG_PROJECTION = os.environ.get('ROME_DEBUG_PROJECTION', '') in ('1', 'true', 'True') #log uses of fields a search didn't ask for
+
+#annotation posts & edits go through an outbox (see outbox.py), drained by the drain_annotation_writes command
+OUTBOX_SEND_NOW = os.environ.get('ROME_OUTBOX_SEND_NOW', '1') in ('1', 'true', 'True') #also try each write right away, in the background
+OUTBOX_SEND_WORKERS = int(os.environ.get('ROME_OUTBOX_SEND_WORKERS', 2)) #threads per process for those background sends
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('ROME_OUTBOX_MAX_ATTEMPTS', 8)) #after this many failures a write is left as failed
+OUTBOX_RETRY_BACKOFF = int(os.environ.get('ROME_OUTBOX_RETRY_BACKOFF', 30)) #seconds before the first retry; doubles each time
+OUTBOX_MAX_BACKOFF = int(os.environ.get('ROME_OUTBOX_MAX_BACKOFF', 60 * 60))
+OUTBOX_SEND_TIMEOUT = int(os.environ.get('ROME_OUTBOX_SEND_TIMEOUT', 10 * 60)) #a write still sending after this was interrupted
+
+#local mirror of the collection (see mirror.py): read books, pages, prints & annotations from it instead of the BDR
+READ_FROM_MIRROR = os.environ.get('ROME_READ_FROM_MIRROR', '') in ('1', 'true', 'True')
+BDR_MODIFIED_FIELD = os.environ.get('ROME_BDR_MODIFIED_FIELD', 'object_last_modified_dsi') #solr field used for incremental syncs
+
+#caches for BDR data: 'django' (the django cache named by CACHE_ALIAS - one all the worker processes share,
+#e.g. memcached, not locmem) or 'local' (per-process LRU). An annotation edit only clears the caches of the
+#process that sends it, so with 'local' & more than one process, the others show what was there before
+#the edit for up to LOCAL_EDITED_CACHE_TIMEOUT
+CACHE_BACKEND = os.environ.get('ROME_CACHE_BACKEND', 'django')
+CACHE_ALIAS = os.environ.get('ROME_CACHE_ALIAS', 'default')
+LOCAL_EDITED_CACHE_TIMEOUT = int(os.environ.get('ROME_LOCAL_EDITED_CACHE_TIMEOUT', 60)) #with 'local', how long other processes can show an item or list from before an edit
+ITEM_CACHE_SIZE = int(os.environ.get('ROME_ITEM_CACHE_SIZE', 1000))
+ITEM_CACHE_TIMEOUT = int(os.environ.get('ROME_ITEM_CACHE_TIMEOUT', 60 * 60))
+ANNOTATION_CACHE_SIZE = int(os.environ.get('ROME_ANNOTATION_CACHE_SIZE', 5000))
+ANNOTATION_CACHE_TIMEOUT = int(os.environ.get('ROME_ANNOTATION_CACHE_TIMEOUT', 24 * 60 * 60))
+VOCABULARY_CACHE_SIZE = int(os.environ.get('ROME_VOCABULARY_CACHE_SIZE', 5000))
+VOCABULARY_CACHE_TIMEOUT = int(os.environ.get('ROME_VOCABULARY_CACHE_TIMEOUT', 10 * 60)) #how stale other processes can be after an edit
+SEARCH_CACHE_SIZE = int(os.environ.get('ROME_SEARCH_CACHE_SIZE', 200))
+SEARCH_CACHE_SOFT_TTL = int(os.environ.get('ROME_SEARCH_CACHE_SOFT_TTL', 10 * 60)) #after this, serve stale & refresh
+SEARCH_CACHE_HARD_TTL = int(os.environ.get('ROME_SEARCH_CACHE_HARD_TTL', 24 * 60 * 60)) #after this, fetch before serving
 
 def setup_logger(filename):
     '''Configures a logger to write to console & <filename>.'''
@@ -32,3 +75,7 @@ def setup_logger(filename):
 app_dir = os.path.dirname(os.path.abspath(__file__))
 logger = setup_logger(os.path.join(app_dir, 'ttwr.log'))
 
+
+#on-disk copies of the people's TEI (see tei.py), rechecked with the BDR once they're older than TEI_REVALIDATE_AFTER seconds
+TEI_CACHE_DIR = os.environ.get('ROME_TEI_CACHE_DIR', os.path.join(app_dir, 'tei_cache'))
+TEI_REVALIDATE_AFTER = int(os.environ.get('ROME_TEI_REVALIDATE_AFTER', 60 * 60))
@@ -0,0 +1,210 @@
+import os
+import json
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+try:
+    import ijson #optional: lets big search responses be decoded as they arrive
+except ImportError:
+    ijson = None
+from . import app_settings
+from .caches import item_cache, search_cache
+
+# One requests.Session (and so one urllib3 connection pool) per worker process.
+# The pid check makes sure a forked worker never reuses its parent's sockets.
+_state = {'pid': None, 'session': None}
+_lock = threading.Lock()
+
+TIMEOUT = (app_settings.BDR_CONNECT_TIMEOUT, app_settings.BDR_READ_TIMEOUT)
+
+
+def _make_session():
+    #only idempotent requests get retried - POSTs/PUTs to the BDR never do
+    retry = Retry(
+        total=app_settings.BDR_MAX_RETRIES,
+        backoff_factor=app_settings.BDR_RETRY_BACKOFF,
+        status_forcelist=[500, 502, 503, 504],
+        method_whitelist=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=app_settings.BDR_POOL_SIZE, pool_maxsize=app_settings.BDR_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        with _lock:
+            if _state['pid'] != pid:
+                _state['session'] = _make_session()
+                _state['pid'] = pid
+    return _state['session']
+
+
+# URLs
+def api_url(path):
+    return 'https://%s/api/%s' % (app_settings.BDR_SERVER, path)
+
+def item_url(pid):
+    return api_url('items/%s/' % pid)
+
+def search_url():
+    return api_url('search/')
+
+def collection_url(collection_id=app_settings.BDR_COLLECTION_ID):
+    return api_url('collections/%s/' % collection_id)
+
+def mods_url(pid):
+    return '%s%s/' % (app_settings.BDR_ANNOTATION_URL, pid)
+
+def datastream_url(pid, dsid):
+    return 'https://%s/fedora/objects/%s/datastreams/%s/content' % (app_settings.BDR_SERVER, pid, dsid)
+
+
+# Requests
+def get(url, params=None, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url, params=params, **kwargs)
+
+def post(url, data=None, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().post(url, data=data, **kwargs)
+
+def put(url, data=None, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().put(url, data=data, **kwargs)
+
+def get_json(url, params=None):
+    r = get(url, params=params)
+    if not r.ok:
+        raise Exception('error retrieving %s: %s - %s' % (r.url, r.status_code, r.text))
+    return json.loads(r.text)
+
+
+def get_item(pid):
+    '''Returns the item json for <pid> (read through item_cache), or None if the BDR doesn't return it.
+    The dict can be shared with other requests, so don't modify it.'''
+    data = item_cache.get(pid)
+    if data is not None:
+        return data
+    r = get(item_url(pid))
+    if not r.ok:
+        app_settings.logger.error(u'TTWR - error retrieving url %s' % r.url)
+        app_settings.logger.error(u'TTWR - response: %s - %s' % (r.status_code, r.text))
+        return None
+    data = json.loads(r.text)
+    item_cache.set(pid, data)
+    return data
+
+def invalidate_item(pid):
+    item_cache.delete(pid)
+
+def _normalize(name, value):
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted(_normalize(name, v) for v in value))
+    value = u' '.join((u'%s' % value).split())
+    if name == 'fl':
+        return u','.join(sorted(set(f.strip() for f in value.split(u',') if f.strip())))
+    return value
+
+def search_key(url, params):
+    '''Cache key for a search: the same query & field list give the same key,
+    whatever the whitespace, param order, fq order or fl order.'''
+    return (url, tuple(sorted((name, _normalize(name, value)) for name, value in params.items())))
+
+def field_list(fields=None):
+    '''The fl param for a search that needs just <fields> (all fields if it's None).'''
+    return u','.join(fields) if fields else u'*'
+
+def _project(params, fields):
+    return dict(params, fl=field_list(fields)) if fields else params
+
+def _search(url, params, cached):
+    if not cached:
+        return get_json(url, params=params)
+    return search_cache.get_or_fetch(search_key(url, params), lambda: get_json(url, params=params))
+
+def search(params, cached=False):
+    '''Runs a query against /api/search/. Cached results are shared, so don't modify them.'''
+    return _search(search_url(), params, cached)
+
+def _results_key(url):
+    #the collections api returns its results under 'items', the search api under 'response'
+    return 'items' if url.startswith(api_url('collections/')) else 'response'
+
+def _results(url, data):
+    return data[_results_key(url)]
+
+def _noting_num_found(events, key, found):
+    for prefix, event, value in events:
+        if prefix == key + '.numFound':
+            found['numFound'] = int(value)
+        yield prefix, event, value
+
+def _stream_docs(url, params, found=None):
+    '''Yields the docs in one search response, decoding them as they're read (with ijson),
+    so the whole response is never in memory at once. Without ijson, falls back to json.loads.
+    The response's numFound goes in found['numFound'] (by the end, wherever it is in the stream).'''
+    found = {} if found is None else found
+    r = get(url, params=params, stream=True)
+    try:
+        if not r.ok:
+            raise Exception('error retrieving %s: %s - %s' % (r.url, r.status_code, r.text))
+        key = _results_key(url)
+        if ijson is None:
+            results = _results(url, json.loads(r.content))
+            found['numFound'] = results['numFound']
+            docs = results['docs']
+        else:
+            r.raw.decode_content = True #in case it's gzipped
+            docs = ijson.common.items(_noting_num_found(ijson.parse(r.raw), key, found), '%s.docs.item' % key)
+        for doc in docs:
+            yield doc
+    finally:
+        r.close()
+
+def _paged(params):
+    #start/rows paging needs a fixed order, or consecutive requests can skip or repeat docs
+    return params if 'sort' in params else dict(params, sort='pid asc')
+
+def iter_docs(url, params, chunk_size=app_settings.SEARCH_CHUNK_SIZE, cached=False, fields=None):
+    '''Yields the docs matching <params>, requesting them chunk_size rows at a time, in a stable
+    order (pid, unless params has a sort). If <fields> is given, only those fields are requested.
+    Uncached searches are streamed (see _stream_docs), so they're the ones to use for reading
+    through a whole collection. Cached, the whole result is cached as one entry, so it's one snapshot.'''
+    params = _paged(_project(params, fields))
+    if cached:
+        key = ('all_docs', chunk_size, search_key(url, params))
+        for doc in search_cache.get_or_fetch(key, lambda: list(_iter_chunks(url, params, chunk_size))):
+            yield doc
+        return
+    for doc in _iter_chunks(url, params, chunk_size):
+        yield doc
+
+def _iter_chunks(url, params, chunk_size):
+    #stops on numFound, not on a short chunk, in case the server caps rows below chunk_size; it's
+    #taken from the first chunk once that's read through (it can come after the docs), & only
+    #asked for separately if the response doesn't have it
+    num_found = None
+    start = 0
+    while num_found is None or start < num_found:
+        found = {}
+        num_docs = 0
+        for doc in _stream_docs(url, dict(params, start=start, rows=chunk_size), found):
+            num_docs += 1
+            yield doc
+        start += num_docs
+        if not num_docs:
+            break #fewer docs than numFound said - don't loop forever
+        if num_found is None:
+            num_found = found['numFound'] if 'numFound' in found else count(url, params)
+
+def count(url, params, cached=False):
+    return _results(url, _search(url, dict(params, rows=0), cached))['numFound']
+
+def get_mods(pid):
+    return get(mods_url(pid))
@@ -0,0 +1,189 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from . import app_settings
+
+
+class LocalCache(object):
+    '''Bounded, thread-safe, in-process LRU cache; every entry also expires after its timeout.'''
+
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] < time.time():
+            del self._entries[key]
+            return None
+        #move to the most-recently-used end
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def _store(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout else None
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live_entry(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._store(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._live_entry(key) is not None:
+                return False
+            self._store(key, value, timeout)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _key_text(key):
+    #a pid from the db or a url is unicode, the same pid from code can be str; they're one key
+    if isinstance(key, (list, tuple)):
+        return u'(%s)' % u','.join(_key_text(k) for k in key)
+    if isinstance(key, str):
+        key = key.decode('utf-8')
+    return u'%r' % key
+
+
+class DjangoCache(object):
+    '''Stores entries in one of the project's django caches, so all workers share them.'''
+
+    def __init__(self, prefix, timeout=300, alias='default'):
+        from django.core.cache import get_cache
+        self._cache = get_cache(alias)
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def _key(self, key):
+        #pids & queries can contain characters memcached doesn't accept in keys
+        return 'ttwr:%s:%s' % (self.prefix, hashlib.md5(_key_text(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        return self._cache.get(self._key(key), default)
+
+    def set(self, key, value, timeout=None):
+        self._cache.set(self._key(key), value, self.timeout if timeout is None else timeout)
+
+    def add(self, key, value, timeout=None):
+        return self._cache.add(self._key(key), value, self.timeout if timeout is None else timeout)
+
+    def delete(self, key):
+        self._cache.delete(self._key(key))
+
+
+class StaleWhileRevalidateCache(object):
+    '''Entries are served as-is until soft_ttl; after that they're still served, while one
+    background thread fetches a replacement. Only after hard_ttl does a request wait for the fetch.'''
+
+    REFRESH_LOCK_TIMEOUT = 5 * 60
+
+    def __init__(self, backend, soft_ttl, hard_ttl):
+        self.backend = backend
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+
+    def get_or_fetch(self, key, fetch):
+        entry = self.backend.get(key)
+        if entry is None:
+            return self._fetch_and_store(key, fetch)
+        value, fetched_at = entry
+        if time.time() - fetched_at > self.soft_ttl:
+            self._refresh_in_background(key, fetch)
+        return value
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def _fetch_and_store(self, key, fetch):
+        value = fetch()
+        self.backend.set(key, (value, time.time()), self.hard_ttl)
+        return value
+
+    def _refresh_in_background(self, key, fetch):
+        lock_key = ('refreshing', key)
+        if not self.backend.add(lock_key, True, self.REFRESH_LOCK_TIMEOUT):
+            return #another thread/worker is already on it
+        def refresh():
+            try:
+                self._fetch_and_store(key, fetch)
+            except Exception as e:
+                app_settings.logger.error(u'TTWR - error refreshing cached %s: %s' % (key, e))
+            finally:
+                self.backend.delete(lock_key)
+                #fetches can use the database (e.g. in mirror mode), & this thread's connection isn't closed for it
+                from django.db import connection
+                connection.close()
+        t = threading.Thread(target=refresh)
+        t.daemon = True
+        t.start()
+
+
+def make_cache(prefix, max_entries, timeout, edited=False):
+    '''<edited> caches are cleared when what they hold is edited (e.g. an annotation is written); kept
+    in-process, they're only cleared in the process that made the edit, so the others' copies expire sooner instead.'''
+    if app_settings.CACHE_BACKEND == 'django':
+        return DjangoCache(prefix, timeout=timeout, alias=app_settings.CACHE_ALIAS)
+    if edited:
+        timeout = min(timeout, app_settings.LOCAL_EDITED_CACHE_TIMEOUT)
+    return LocalCache(max_entries=max_entries, timeout=timeout)
+
+
+#item json from /api/items/<pid>/, keyed by pid
+item_cache = make_cache('items', app_settings.ITEM_CACHE_SIZE, app_settings.ITEM_CACHE_TIMEOUT, edited=True)
+
+#parsed annotation MODS (see views.get_annotation_record), keyed by annotation pid; edits clear it from
+#whichever process sends them, so every worker needs to see that (see app_settings.CACHE_BACKEND)
+annotation_cache = make_cache('annotations', app_settings.ANNOTATION_CACHE_SIZE, app_settings.ANNOTATION_CACHE_TIMEOUT, edited=True)
+
+#ids of each book's pages with a public annotation, under ('book', <pid>)
+annotated_cache = make_cache('annotated', app_settings.ITEM_CACHE_SIZE, app_settings.ITEM_CACHE_TIMEOUT, edited=True)
+
+#each book's page order, {page pid: (order, previous page pid, next page pid)}, keyed by book pid
+page_order_cache = make_cache('page_order', app_settings.ITEM_CACHE_SIZE, app_settings.ITEM_CACHE_TIMEOUT)
+
+#facet value lists worked out from the database (e.g. biography roles), keyed by facet name
+facet_cache = make_cache('facets', 100, app_settings.ITEM_CACHE_TIMEOUT, edited=True)
+
+#Biography, Role & Genre objects by ('person', trp_id), ('role', text) & ('genre', text) (see models.resolve_vocabulary);
+#always in-process, since it holds model objects & is cleared by this process's model signals (misses aren't cached)
+vocabulary_cache = LocalCache(app_settings.VOCABULARY_CACHE_SIZE, app_settings.VOCABULARY_CACHE_TIMEOUT)
+
+#decoded search responses, keyed by normalized request (see bdr_client.search_key)
+search_cache = StaleWhileRevalidateCache(
+        make_cache('search', app_settings.SEARCH_CACHE_SIZE, app_settings.SEARCH_CACHE_HARD_TTL),
+        soft_ttl=app_settings.SEARCH_CACHE_SOFT_TTL,
+        hard_ttl=app_settings.SEARCH_CACHE_HARD_TTL)
+
+#the sorted book & print lists (see sorting.get_sorted): whole collections, too big for one memcached item &
+#not to be pushed out by other searches, so always in-process, in a cache of their own. Processes other than
+#the one that clears an entry (e.g. after a mirror sync) rebuild theirs once it's stale
+collection_cache = StaleWhileRevalidateCache(
+        LocalCache(10, app_settings.SEARCH_CACHE_HARD_TTL),
+        soft_ttl=app_settings.SEARCH_CACHE_SOFT_TTL,
+        hard_ttl=app_settings.SEARCH_CACHE_HARD_TTL)
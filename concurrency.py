@@ -0,0 +1,70 @@
+import os
+import time
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from django.db import connection
+from . import app_settings
+
+# Bounded pools of threads per worker process. The 'fetch' pool is shared by every
+# request in the process, for waiting on BDR round-trips in parallel. Don't submit to
+# a pool from a task that's already running on it - that can deadlock; work that
+# fans out itself (e.g. outbox sends) gets a pool of its own.
+_pools = {} #name: (pid, pool)
+_lock = threading.Lock()
+
+
+def get_pool(name='fetch', size=None):
+    pid = os.getpid()
+    entry = _pools.get(name)
+    if entry is None or entry[0] != pid:
+        with _lock:
+            entry = _pools.get(name)
+            if entry is None or entry[0] != pid:
+                entry = (pid, ThreadPool(size or app_settings.FETCH_WORKERS))
+                _pools[name] = entry
+    return entry[1]
+
+
+def _run(func, item):
+    try:
+        return func(item)
+    finally:
+        #pool threads outlive the request, & a connection left open on one goes stale after the
+        #db's idle timeout (e.g. reading from the mirror), so each task closes its own
+        connection.close()
+
+
+def map_with_deadline(func, items, timeout):
+    '''Runs func(item) for every item on the pool. Returns a (result, error) pair per item,
+    in the order of items; error is set if the call raised, or hadn't finished <timeout>
+    seconds after the first call was submitted.'''
+    pool = get_pool()
+    pending = [pool.apply_async(_run, (func, item)) for item in items]
+    deadline = time.time() + timeout
+    results = []
+    for async_result in pending:
+        try:
+            results.append((async_result.get(max(0, deadline - time.time())), None))
+        except TimeoutError:
+            results.append((None, TimeoutError('timed out after %ss' % timeout)))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+class RateLimit(object):
+    '''Spaces calls out to at most <per_second> a second, across threads: each caller of wait()
+    gets the next free slot and sleeps until it. per_second=0 means no limit.'''
+
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second else 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0, slot - now))
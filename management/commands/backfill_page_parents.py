@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from rome_app import app_settings, bdr_client
+from rome_app.models import PageParent
+
+
+class Command(BaseCommand):
+    help = 'Fills the page-to-book index (PageParent) for every page in the collection, in one pass over the BDR.'
+
+    def handle(self, *args, **options):
+        params = {'q': 'ir_collection_id:%s AND rel_is_part_of_ssim:*' % app_settings.BDR_COLLECTION_ID}
+        docs = bdr_client.iter_docs(bdr_client.search_url(), params, fields=('pid', 'rel_is_part_of_ssim'))
+        pairs = []
+        for doc in docs:
+            pairs.append((doc['pid'], doc['rel_is_part_of_ssim'][0]))
+            if len(pairs) >= PageParent.BATCH_SIZE:
+                PageParent.record(pairs)
+                pairs = []
+        PageParent.record(pairs)
+        self.stdout.write('%s pages indexed\n' % PageParent.objects.count())
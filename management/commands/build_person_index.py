@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from rome_app.models import Biography, PersonWorksIndex
+
+
+class Command(BaseCommand):
+    args = '[trp_id trp_id ...]'
+    help = 'Rebuilds the books/prints/annotated pages index for the given people (everyone by default).'
+
+    def handle(self, *args, **options):
+        bios = Biography.objects.all()
+        if args:
+            bios = bios.filter(trp_id__in=['%04d' % int(trp_id) for trp_id in args])
+            if not bios:
+                raise CommandError('No people with trp_id %s' % ', '.join(args))
+        for bio in bios:
+            try:
+                index = PersonWorksIndex.build(bio)
+            except Exception as e:
+                #the old index (if any) is kept - run it again for this person later
+                self.stderr.write('%s: not rebuilt - %s\n' % (bio, e))
+                continue
+            self.stdout.write('%s: %s works\n' % (bio, index.works.count()))
@@ -0,0 +1,28 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from rome_app import outbox
+
+
+class Command(BaseCommand):
+    help = 'Sends the annotation posts & edits waiting in the outbox to the BDR, retrying failures with backoff.'
+    option_list = BaseCommand.option_list + (
+        make_option('--forever', action='store_true', dest='forever', default=False,
+            help='Keep draining, every --interval seconds (e.g. under supervisor), instead of once (e.g. from cron).'),
+        make_option('--interval', action='store', type='int', dest='interval', default=5,
+            help='Seconds between drains with --forever.'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+            help='First queue the writes that were given up on again (not interrupted posts - requeue those from the admin, after checking the BDR).'),
+    )
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            self.stdout.write('%s failed writes queued again\n' % outbox.retry_failed())
+        while True:
+            released = outbox.release_interrupted()
+            (tried, landed) = outbox.drain()
+            if tried or released:
+                self.stdout.write('%s writes sent, %s landed, %s interrupted writes released\n' % (tried, landed, released))
+            if not options['forever']:
+                break
+            time.sleep(options['interval'])
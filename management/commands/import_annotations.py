@@ -0,0 +1,232 @@
+import os
+import csv
+import json
+import tarfile
+import zipfile
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from rome_app import app_settings, outbox
+from rome_app.concurrency import RateLimit
+from rome_app.forms import AnnotationForm
+from rome_app.models import Annotation, AnnotationWrite, Biography, Genre, PageParent, Role, get_item
+from rome_app.mods_parser import parse_annotation_fields
+
+
+def _mods_sources(path):
+    '''(name, xml) for each .xml file in a directory, zip or tar archive, in name order.'''
+    if os.path.isdir(path):
+        names = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            names.extend(os.path.relpath(os.path.join(dirpath, f), path) for f in filenames if f.lower().endswith('.xml'))
+        for name in sorted(names):
+            with open(os.path.join(path, name), 'rb') as f:
+                yield name, f.read()
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(n for n in archive.namelist() if n.lower().endswith('.xml')):
+                yield name, archive.read(name)
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as archive:
+            members = [m for m in archive.getmembers() if m.isfile() and m.name.lower().endswith('.xml')]
+            for member in sorted(members, key=lambda m: m.name):
+                yield member.name, archive.extractfile(member).read()
+    else:
+        raise CommandError('%s is not a directory, zip or tar archive' % path)
+
+
+def _read_targets(path):
+    #csv of <file name or identifier>,<image pid>
+    targets = {}
+    with open(path, 'rb') as f:
+        for row in csv.reader(f):
+            if len(row) >= 2 and row[0].strip():
+                targets[row[0].strip().decode('utf8')] = row[1].strip().decode('utf8')
+    return targets
+
+def _target_pid(name, fields, targets):
+    #the targets file, by file name or any of the record's identifiers; then a pid in the host relatedItem
+    keys = [os.path.basename(name), os.path.splitext(os.path.basename(name))[0]]
+    keys.extend(fields['identifiers'].values())
+    keys.extend(fields['host_identifiers'].values())
+    for key in keys:
+        if key in targets:
+            return targets[key]
+    for id_type, value in fields['host_identifiers'].items():
+        if id_type in ('bdr', 'pid') or value.startswith(u'%s:' % app_settings.PID_PREFIX):
+            return value
+    return None
+
+
+def _source_key(source, name):
+    #what AnnotationWrite.source records for a file in <source>
+    source = source if isinstance(source, unicode) else source.decode('utf8', 'replace')
+    return (u'%s/%s' % (os.path.basename(source), name))[:254]
+
+
+def _writes(pks, batch_size=500):
+    #the AnnotationWrites for <pks>, a batch at a time (sqlite limits the size of an IN)
+    pks = list(pks)
+    for i in range(0, len(pks), batch_size):
+        for write in AnnotationWrite.objects.filter(pk__in=pks[i:i+batch_size]):
+            yield write
+
+
+def _read_checkpoint(path):
+    #one json line per record already queued: {"name": file name, "write": AnnotationWrite pk}
+    done = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    done[entry['name']] = entry['write']
+    return done
+
+
+class Command(BaseCommand):
+    args = '<directory or archive of MODS files>'
+    help = ('Validates MODS annotation files the way the annotation form would, queues the valid ones in the '
+            'outbox and posts them to the BDR in parallel. Re-running with the same checkpoint picks up where it stopped.')
+    option_list = BaseCommand.option_list + (
+        make_option('--targets', action='store', dest='targets', default=None,
+            help='CSV of <file name or MODS identifier>,<image pid>, for records without a pid in their host relatedItem.'),
+        make_option('--annotator', action='store', dest='annotator', default='',
+            help='Annotator for records without a resp note.'),
+        make_option('--workers', action='store', type='int', dest='workers', default=app_settings.FETCH_WORKERS,
+            help='Posts to run at once.'),
+        make_option('--rate', action='store', type='float', dest='rate', default=5,
+            help='Most posts to start per second (0 for no limit).'),
+        make_option('--checkpoint', action='store', dest='checkpoint', default=None,
+            help='Checkpoint file (default: <source>.checkpoint).'),
+        make_option('--report', action='store', dest='report', default=None,
+            help='CSV of the records that weren\'t imported, and why (default: <source>.report.csv).'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only validate & write the report.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('give one directory or archive of MODS files')
+        source = args[0].rstrip(os.sep)
+        checkpoint_path = options['checkpoint'] or u'%s.checkpoint' % source
+        report_path = options['report'] or u'%s.report.csv' % source
+        targets = _read_targets(options['targets']) if options['targets'] else {}
+        queued = _read_checkpoint(checkpoint_path)
+        self.people = dict((b.trp_id, b) for b in Biography.objects.all())
+        self.roles = dict((r.text.lower(), r) for r in Role.objects.all())
+        self.genres = dict((g.text.lower(), g) for g in Genre.objects.all())
+        self.annotator = options['annotator'].decode('utf8')
+
+        problems = []
+        records = []
+        for name, xml in _mods_sources(source):
+            name = name if isinstance(name, unicode) else name.decode('utf8', 'replace')
+            if name in queued:
+                continue
+            (record, record_problems) = self._validate(name, xml, targets)
+            if record_problems:
+                problems.extend((name, problem) for problem in record_problems)
+            else:
+                records.append(record)
+        #each target once, in parallel - the BDR has to have it
+        pool = ThreadPool(options['workers'])
+        target_pids = sorted(set(r['image_pid'] for r in records))
+        def exists(pid):
+            #(found, error) - one target failing to load shouldn't stop the others
+            try:
+                return (get_item(pid) is not None, None)
+            except Exception as e:
+                return (False, u'%s' % e)
+            finally:
+                connection.close() #each thread has its own connection
+        found = dict(zip(target_pids, pool.map(exists, target_pids)))
+        for record in records:
+            (target_found, error) = found[record['image_pid']]
+            if error:
+                problems.append((record['name'], u'could not check target %s: %s' % (record['image_pid'], error)))
+            elif not target_found:
+                problems.append((record['name'], u'target %s not found in the BDR' % record['image_pid']))
+        records = [r for r in records if found[r['image_pid']][0]]
+
+        if not options['dry_run']:
+            with open(checkpoint_path, 'ab') as checkpoint:
+                for record in records:
+                    #a crash after queueing but before the checkpoint line leaves the write in the outbox,
+                    #so look for it there first rather than queue (& post) the record again
+                    record_source = _source_key(source, record['name'])
+                    pks = list(AnnotationWrite.objects.filter(source=record_source, kind=AnnotationWrite.NEW).values_list('pk', flat=True)[:1])
+                    if pks:
+                        pk = pks[0]
+                    else:
+                        pk = outbox.queue_new(record['annotation'], record['image_pid'], u'import',
+                                book_pid=PageParent.book_pid_for(record['image_pid']) or '', send_now=False,
+                                source=record_source).pk
+                    checkpoint.write(json.dumps({'name': record['name'], 'write': pk}) + '\n')
+                    checkpoint.flush()
+                    queued[record['name']] = pk
+            problems.extend(self._send(queued, pool, RateLimit(options['rate'])))
+        pool.close()
+
+        with open(report_path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'problem'])
+            for (name, problem) in problems:
+                writer.writerow([name.encode('utf8'), problem.encode('utf8')])
+        self.stdout.write('%s records %s, %s problems (see %s)\n' % (len(records), 'valid' if options['dry_run'] else 'queued',
+                len(problems), report_path))
+
+    def _validate(self, name, xml, targets):
+        '''Returns (record, problems): the Annotation to post & its target, or why it can't be.'''
+        try:
+            fields = parse_annotation_fields(xml)
+        except Exception as e:
+            return None, [u'not valid MODS: %s' % e]
+        problems = []
+        genre = None
+        if fields['genre']:
+            genre = self.genres.get(fields['genre'].lower())
+            if not genre:
+                problems.append(u'unknown genre "%s"' % fields['genre'])
+        form = AnnotationForm({'title': fields['title'], 'title_language': fields['title_language'],
+                'english_title': fields['english_title'], 'genre': genre.pk if genre else '',
+                'abstract': fields['abstract'], 'impression_date': fields['impression_date']})
+        if not form.is_valid():
+            problems.extend(u'%s: %s' % (field, u' '.join(errors)) for field, errors in form.errors.items())
+        people = []
+        for p in fields['people']:
+            try:
+                person = self.people.get('%04d' % int(p['trp_id']))
+            except ValueError:
+                person = None
+            role = self.roles.get(p['role'].lower())
+            if not person:
+                problems.append(u'no person with trp_id "%s"' % p['trp_id'])
+            if not role:
+                problems.append(u'unknown role "%s"' % p['role'])
+            people.append({'person': person, 'role': role})
+        annotator = fields['annotator'] or self.annotator
+        if not annotator:
+            problems.append(u'no annotator (resp note), and no --annotator')
+        image_pid = _target_pid(name, fields, targets)
+        if not image_pid:
+            problems.append(u'no target image pid')
+        if problems:
+            return None, problems
+        annotation = Annotation.from_form_data(image_pid, annotator, form.cleaned_data, people, fields['inscriptions'])
+        return {'name': name, 'image_pid': image_pid, 'annotation': annotation}, []
+
+    def _send(self, queued, pool, limit):
+        '''Sends the queued writes that haven't landed; returns (name, problem) for those that still haven't.
+        Failed ones stay in the outbox, for drain_annotation_writes to retry.'''
+        names = dict((pk, name) for name, pk in queued.items())
+        pending = [w.pk for w in _writes(names) if w.status == AnnotationWrite.PENDING]
+        def send(pk):
+            limit.wait()
+            try:
+                return outbox.send(pk)
+            finally:
+                connection.close() #each thread has its own connection
+        pool.map(send, pending)
+        return [(names[w.pk], u'not posted yet (%s): %s' % (w.status, w.last_error)) for w in _writes(names) if w.status != AnnotationWrite.DONE]
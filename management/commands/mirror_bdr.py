@@ -0,0 +1,15 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from rome_app.mirror import sync
+
+
+class Command(BaseCommand):
+    help = 'Copies BDR collection 621 into the local mirror tables (incrementally, after the first run).'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Reload everything and drop objects that are no longer in the BDR.'),
+    )
+
+    def handle(self, *args, **options):
+        run = sync(full=options['full'])
+        self.stdout.write('%s sync finished in %s\n' % ('Full' if run.full else 'Incremental', run.finished - run.started))
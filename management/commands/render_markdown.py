@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from rome_app.models import Biography, Essay, render_markdown
+
+
+class Command(BaseCommand):
+    help = 'Renders the stored html of every essay & biography from its markdown (saving one does this for it).'
+
+    def handle(self, *args, **options):
+        #update() rather than save(), so nothing else about the rows changes
+        for essay in Essay.objects.all():
+            Essay.objects.filter(pk=essay.pk).update(text_html=render_markdown(essay.text))
+        for bio in Biography.objects.all():
+            Biography.objects.filter(pk=bio.pk).update(bio_html=render_markdown(bio.bio))
+        self.stdout.write('rendered %s essays & %s biographies\n' % (Essay.objects.count(), Biography.objects.count()))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from rome_app.models import Biography
+
+
+class Command(BaseCommand):
+    help = 'Fills BiographyRole from the roles field of every biography (Biography.save keeps it up to date after that).'
+
+    def handle(self, *args, **options):
+        count = 0
+        for bio in Biography.objects.all():
+            bio.sync_roles()
+            count += 1
+        self.stdout.write('roles synced for %s biographies\n' % count)
@@ -0,0 +1,179 @@
+'''Keeps a local copy of BDR collection 621 in the Mirrored* tables.
+
+A full sync loads every book (with its pages), print and public annotation. Later syncs only
+ask the BDR for objects modified since the last finished sync started; a book's pages
+are refreshed with it, and an annotation's page or print is refreshed with the annotation.
+Objects removed from the BDR are only dropped by a full sync.
+'''
+import json
+from datetime import timedelta
+from django.utils import timezone
+from . import app_settings, bdr_client, sorting
+from .app_settings import logger
+from .caches import page_order_cache
+from .concurrency import map_with_deadline
+from .mods_parser import parse_annotation
+from .models import (Book, Print, Annotation, MirroredBook, MirroredPage, MirroredPrint, MirroredAnnotation,
+        MirroredContributor, MirrorSync, PageParent)
+
+BATCH_SIZE = 100
+BATCH_DEADLINE = 5 * 60
+#re-request a bit before the last sync started, in case of clock skew or a slow solr commit
+SYNC_OVERLAP = timedelta(hours=1)
+
+
+def _batches(items):
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i:i+BATCH_SIZE]
+
+def _solr_date(dt):
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _add_since(params, since):
+    if since:
+        fq = params.get('fq', [])
+        params['fq'] = list(fq) + ['%s:[%s TO *]' % (app_settings.BDR_MODIFIED_FIELD, _solr_date(since - SYNC_OVERLAP))]
+    return params
+
+def _fetch_all(func, pids):
+    '''Runs func(pid) on the worker pool; returns {pid: result} for the calls that worked.'''
+    results = {}
+    for batch in _batches(pids):
+        for pid, (result, error) in zip(batch, map_with_deadline(func, batch, BATCH_DEADLINE)):
+            if error:
+                logger.error(u'TTWR - mirror: error fetching %s: %s' % (pid, error))
+            elif result is not None:
+                results[pid] = result
+    return results
+
+def _fetch_item(pid):
+    bdr_client.invalidate_item(pid) #we want the BDR's current version
+    return bdr_client.get_item(pid)
+
+def _fetch_annotation(pid):
+    r = bdr_client.get_mods(pid)
+    if not r.ok:
+        raise Exception('error retrieving annotation %s: %s' % (pid, r.status_code))
+    return parse_annotation(r.content)
+
+def _store(model, pid, data, modified='', **fields):
+    try:
+        obj = model.objects.get(pid=pid)
+    except model.DoesNotExist:
+        obj = model(pid=pid)
+    obj.data = json.dumps(data)
+    obj.modified = modified or obj.modified
+    for name, value in fields.items():
+        setattr(obj, name, value)
+    obj.save()
+    return obj
+
+def _store_contributors(pid, data):
+    MirroredContributor.objects.filter(pid=pid).delete()
+    MirroredContributor.objects.bulk_create([MirroredContributor(field=field, name=name, pid=pid)
+            for field in ('name', 'contributor') for name in data.get(field, [])])
+
+
+def _sync_pages(book, book_data):
+    parts = book_data.get('relations', {}).get('hasPart', [])
+    items = _fetch_all(_fetch_item, [part['pid'] for part in parts])
+    for part in parts:
+        if part['pid'] in items:
+            _store(MirroredPage, part['pid'], items[part['pid']], book=book, order=int(part['order']))
+    MirroredPage.objects.filter(book=book).exclude(pid__in=[part['pid'] for part in parts]).delete()
+    PageParent.record_book(book.pid, book_data)
+
+def _sync_books(since):
+    params = _add_since(dict(Book._search_params(Book.MIRROR_QUERY), fl='pid,%s' % app_settings.BDR_MODIFIED_FIELD), since)
+    docs = list(bdr_client.iter_docs(bdr_client.collection_url(), params))
+    items = _fetch_all(_fetch_item, [doc['pid'] for doc in docs])
+    for doc in docs:
+        if doc['pid'] in items:
+            book = _store(MirroredBook, doc['pid'], items[doc['pid']], doc.get(app_settings.BDR_MODIFIED_FIELD, ''))
+            _store_contributors(doc['pid'], items[doc['pid']])
+            _sync_pages(book, items[doc['pid']])
+            page_order_cache.delete(doc['pid'])
+    return [doc['pid'] for doc in docs]
+
+def _sync_prints(since):
+    params = _add_since({'q': Print.LIST_QUERY, 'fl': 'pid,%s' % app_settings.BDR_MODIFIED_FIELD}, since)
+    docs = list(bdr_client.iter_docs(bdr_client.search_url(), params))
+    items = _fetch_all(_fetch_item, [doc['pid'] for doc in docs])
+    for doc in docs:
+        if doc['pid'] in items:
+            _store(MirroredPrint, doc['pid'], items[doc['pid']], doc.get(app_settings.BDR_MODIFIED_FIELD, ''))
+            _store_contributors(doc['pid'], items[doc['pid']])
+    return [doc['pid'] for doc in docs]
+
+def _sync_annotations(since):
+    params = _add_since({'q': Annotation.PUBLIC_QUERY, 'fl': 'pid,rel_is_annotation_of_ssim,%s' % app_settings.BDR_MODIFIED_FIELD}, since)
+    docs = [doc for doc in bdr_client.iter_docs(bdr_client.search_url(), params) if doc.get('rel_is_annotation_of_ssim')]
+    records = _fetch_all(_fetch_annotation, [doc['pid'] for doc in docs])
+    for doc in docs:
+        if doc['pid'] in records:
+            store_annotation(doc['pid'], doc['rel_is_annotation_of_ssim'][0], records[doc['pid']], doc.get(app_settings.BDR_MODIFIED_FIELD, ''))
+    return docs
+
+def _delete_unseen(model, seen):
+    #compared here rather than with a huge NOT IN, which sqlite can't take
+    stale = list(set(model.objects.values_list('pid', flat=True)) - set(seen))
+    for batch in _batches(stale):
+        model.objects.filter(pid__in=batch).delete()
+
+def _refresh_targets(pids):
+    #the page or print json lists its annotations, so it changes along with them
+    pids = set(pids)
+    for model in (MirroredPage, MirroredPrint):
+        mirrored = [pid for pid in model.objects.values_list('pid', flat=True) if pid in pids]
+        items = _fetch_all(_fetch_item, mirrored)
+        for pid in items:
+            model.objects.filter(pid=pid).update(data=json.dumps(items[pid]))
+
+
+def store_annotation(pid, target_pid, record, modified=''):
+    try:
+        annotation = MirroredAnnotation.objects.get(pid=pid)
+    except MirroredAnnotation.DoesNotExist:
+        annotation = MirroredAnnotation(pid=pid)
+    annotation.target_pid = target_pid
+    annotation.title = record.get('orig_title') or ''
+    annotation.record = json.dumps(record, separators=(',', ':'))
+    annotation.modified = modified or annotation.modified
+    annotation.save()
+    return annotation
+
+def annotation_written(pid, target_pid, mods_xml):
+    '''Brings the mirror up to date after this site posts or edits an annotation. <mods_xml> can be
+    unicode, as it is when read back from an AnnotationWrite.'''
+    store_annotation(pid, target_pid, parse_annotation(mods_xml))
+    _refresh_targets([target_pid])
+
+
+def sync(full=False):
+    '''Runs a full or incremental sync; returns the MirrorSync row for it.'''
+    since = None
+    if not full:
+        try:
+            since = MirrorSync.objects.filter(finished__isnull=False).latest().started
+        except MirrorSync.DoesNotExist:
+            full = True #nothing to go on - load everything
+    run = MirrorSync.objects.create(started=timezone.now(), full=full)
+    book_pids = _sync_books(since)
+    print_pids = _sync_prints(since)
+    annotation_docs = _sync_annotations(since)
+    if full:
+        _delete_unseen(MirroredBook, book_pids)
+        _delete_unseen(MirroredPrint, print_pids)
+        _delete_unseen(MirroredAnnotation, [doc['pid'] for doc in annotation_docs])
+        _delete_unseen(MirroredContributor, book_pids + print_pids)
+    else:
+        _refresh_targets(doc['rel_is_annotation_of_ssim'][0] for doc in annotation_docs)
+    run.finished = timezone.now()
+    run.save()
+    #the precomputed list orders are built from what's in the mirror
+    sorting.invalidate('books')
+    sorting.invalidate('prints')
+    logger.info(u'TTWR - mirror sync (%s): %s books, %s prints, %s annotations' % ('full' if full else 'incremental', len(book_pids), len(print_pids), len(annotation_docs)))
+    return run
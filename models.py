@@ -1,11 +1,26 @@
 from django.http import Http404
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.db.models.signals import post_save, post_delete
 from .  import app_settings
-import requests
+from . import bdr_client
+from .caches import annotated_cache, page_order_cache, facet_cache, vocabulary_cache
+from .concurrency import map_with_deadline
+from .sorting import collation_key, SortedCollection, get_sorted
 import json
+import re
 from eulxml.xmlmap import load_xmlobject_from_string
 from bdrxml import mods
+from markdown_deux import markdown
+
+#transaction.atomic (django 1.6+), or commit_on_success, which it replaced, on older djangos
+_atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+
+def render_markdown(text):
+    #same rendering (and sanitizing) as the templates' markdown filter
+    return markdown(text or u'')
 
 # Database Models
 class Biography(models.Model):
@@ -18,24 +33,28 @@ class Biography(models.Model):
     death_date = models.CharField(max_length=25, null=True, blank=True, help_text='Optional: enter death date as yyyy-mm-dd')
     roles = models.CharField(max_length=254, null=True, blank=True, help_text='Optional: enter roles, separated by a semi-colon')
     bio = models.TextField()
+    bio_html = models.TextField(blank=True, editable=False) #bio rendered from markdown on save
 
     class Meta:
         verbose_name_plural = 'biographies'
         ordering = ['name']
 
     def books(self):
-        return Book.search(query='name:"%s"' % self.name )
+        return Book.search(query='name:"%s"' % self.name, fields=Book.TITLE_FIELDS)
 
     def prints(self):
-        return Print.search(query='contributor:"%s"' % self.name )
+        return Print.search(query='contributor:"%s"' % self.name, fields=Print.TITLE_FIELDS)
 
-    def annotations_by_books_and_prints(self, group_amount=50):
+    def annotations_by_books_and_prints(self, group_amount=50, failures=None):
         # Might need some cleaning up later, see if we can use objects here
+        # Groups whose lookup fails are left out (& added to <failures>, if it's given)
 
         #Look up every annotation for a person
-        num_prints_estimate = 6000
-        query_uri = 'https://%s/api/search/?q=ir_collection_id:621+AND+object_type:"annotation"+AND+contributor:"%s"+AND+display:BDR_PUBLIC&rows=%s&fl=rel_is_annotation_of_ssim,primary_title,pid,nonsort' % (app_settings.BDR_SERVER, self.name, num_prints_estimate)
-        annotations = json.loads(requests.get(query_uri).text)['response']['docs']
+        params = {
+            'q': 'ir_collection_id:%s AND object_type:"annotation" AND contributor:"%s" AND display:BDR_PUBLIC' % (app_settings.BDR_COLLECTION_ID, self.name),
+            'fl': 'rel_is_annotation_of_ssim,primary_title,pid,nonsort',
+        }
+        annotations = bdr_client.iter_docs(bdr_client.search_url(), params)
         pages = dict([(page['rel_is_annotation_of_ssim'][0].split(u':')[-1], page) for page in annotations])
         books = {}
         prints = []
@@ -47,53 +66,60 @@ class Biography(models.Model):
             page['title'] = get_full_title_static(page)
             page['page_id'] = page_id
             page['id'] = page_id.split(u':')[-1]
-            pages_to_look_up.append(pages[page_id]['rel_is_annotation_of_ssim'][0].replace(u':', u'\:'))
+            pages_to_look_up.append(pages[page_id]['rel_is_annotation_of_ssim'][0])
             page['thumb'] = u"https://%s/viewers/image/thumbnail/%s/"  % (app_settings.BDR_SERVER, page['rel_is_annotation_of_ssim'][0])
 
-        num_pages = len(pages_to_look_up)
-        i = 0
-        # Look up which books those pages are part of in groups of group_amount 
+        # Look up which books those pages are part of: from the local mirror when we can, then
+        # with one search per book for the pages PageParent knows the book of, & only for the rest
+        # by pid, in concurrent groups of group_amount
         # (by default 50, any longer tends to break the request because the URL is too long)
-        while(i < num_pages):
-            group = pages_to_look_up[i : i+group_amount]
-            pids = "(pid:" + ("+OR+pid:".join(group)) + ")"
-            book_query = u"https://%s/api/search/?q=%s+AND+display:BDR_PUBLIC&fl=pid,primary_title,nonsort,object_type,rel_is_part_of_ssim,rel_has_pagination_ssim&rows=%s" % (app_settings.BDR_SERVER, pids, group_amount)
-            data = json.loads(requests.get(book_query).text)
-            book_response = data['response']['docs']
-
-            # Create a dict that maps book pids to a list of pages for that book
-            # essentially:
-            # {
-            #    "123456": {
-            #                 'pid':'123456'
-            #                 'title':"Sculpture in Rome"
-            #                 'pages': [{...}, {...}, ...] (all pages in this book with annotations)
-            #              }
-            #    "456789": {
-            #                  ...
-            #              }
-            #    ...
-            # }
-            # Also deals with any prints that came up in the search
-            for p in book_response:
-                try:
-                    pid = p['rel_is_part_of_ssim'][0].split(u':')[-1]
-                    n = int(p['rel_has_pagination_ssim'][0])
-                    
-                    if(pid not in books):
-                        books[pid] = {}
-                        books[pid]['title'] = get_full_title_static(p)
-                        books[pid]['pages'] = dict()
-                        books[pid]['pid'] = pid
-                    books[pid]['pages'][n] = pages[p['pid'].split(u':')[-1]]
-                except KeyError:
-                    pid = p['pid'].split(u':')[-1]
-                    p_obj = {}
-                    p_obj['primary_title'] = get_full_title_static(p)
-                    p_obj['pid'] = p['pid']
-                    prints.append(Print(data=p_obj))
-
-            i += group_amount
+        book_response, pages_to_look_up = _mirrored_page_docs(pages_to_look_up)
+        indexed_docs, pages_to_look_up, indexed_failures = _indexed_page_docs(pages_to_look_up)
+        book_response.extend(indexed_docs)
+        if indexed_failures and failures is not None:
+            failures.append(indexed_failures)
+        groups = [pages_to_look_up[i : i+group_amount] for i in range(0, len(pages_to_look_up), group_amount)]
+        for group, (docs, error) in zip(groups, map_with_deadline(_search_pids, groups, app_settings.SEARCH_FETCH_DEADLINE)):
+            if error:
+                app_settings.logger.error(u'TTWR - error looking up pages for %s: %s' % (self.name, error))
+                if failures is not None:
+                    failures.append(group)
+            else:
+                book_response.extend(docs)
+
+        # Create a dict that maps book pids to a list of pages for that book
+        # essentially:
+        # {
+        #    "123456": {
+        #                 'pid':'123456'
+        #                 'title':"Sculpture in Rome"
+        #                 'pages': [{...}, {...}, ...] (all pages in this book with annotations)
+        #              }
+        #    "456789": {
+        #                  ...
+        #              }
+        #    ...
+        # }
+        # Also deals with any prints that came up in the search
+        PageParent.record(((p['pid'], p['rel_is_part_of_ssim'][0]) for p in book_response if p.get('rel_is_part_of_ssim')), quiet=True)
+        for p in book_response:
+            try:
+                pid = p['rel_is_part_of_ssim'][0].split(u':')[-1]
+                n = int(p['rel_has_pagination_ssim'][0])
+                
+                if(pid not in books):
+                    books[pid] = {}
+                    books[pid]['title'] = get_full_title_static(p)
+                    books[pid]['pages'] = dict()
+                    books[pid]['pid'] = pid
+                books[pid]['pages'][n] = pages[p['pid'].split(u':')[-1]]
+            except KeyError:
+                pid = p['pid'].split(u':')[-1]
+                p_obj = {}
+                p_obj['primary_title'] = get_full_title_static(p)
+                p_obj['pid'] = p['pid']
+                p_obj['annotation_pid'] = pages[pid]['pid']
+                prints.append(Print(data=p_obj))
 
         for b in books:
             books[b]['pages'] = sorted(books[b]['pages'].items())
@@ -107,24 +133,82 @@ class Biography(models.Model):
         new_trp_id = last_trp_id + 1
         return '%04d' % new_trp_id
 
+    def split_roles(self):
+        #the roles field is free text, separated by semi-colons
+        if not self.roles:
+            return []
+        return [role.strip(" ") for role in self.roles.split(';') if role.strip(" ") != '']
+
+    def role_list(self):
+        #from role_rows, so prefetch_related('role_rows') saves a query per person
+        return [row.role for row in self.role_rows.all()]
+
+    def sync_roles(self):
+        '''Makes the BiographyRole rows match the roles field.'''
+        roles = []
+        for role in self.split_roles():
+            if role not in roles:
+                roles.append(role)
+        BiographyRole.objects.filter(biography=self).exclude(role__in=roles).delete()
+        existing = set(BiographyRole.objects.filter(biography=self).values_list('role', flat=True))
+        BiographyRole.objects.bulk_create([BiographyRole(biography=self, role=role) for role in roles if role not in existing])
+        facet_cache.delete('biography_roles')
+
     def save(self, *args, **kwargs):
         if not self.trp_id:
             self.trp_id = self._get_trp_id()
+        self.bio_html = render_markdown(self.bio)
         super(Biography, self).save(*args, **kwargs)
+        self.sync_roles()
 
     def __unicode__(self):
         return u'%s (%s)' % (self.name, self.trp_id)
 
 
+# Biography.roles, one row per role, so the people list can filter & count in the database
+class BiographyRole(models.Model):
+    biography = models.ForeignKey(Biography, related_name='role_rows')
+    role = models.CharField(max_length=254, db_index=True)
+
+    class Meta:
+        unique_together = (('biography', 'role'),)
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.biography_id, self.role)
+
+    @classmethod
+    def facet_values(cls):
+        '''Every role anyone has, sorted; cached until a biography is saved or deleted.'''
+        roles = facet_cache.get('biography_roles')
+        if roles is None:
+            roles = list(cls.objects.order_by('role').values_list('role', flat=True).distinct())
+            facet_cache.set('biography_roles', roles)
+        return roles
+
+def _clear_role_facet(sender, **kwargs):
+    facet_cache.delete('biography_roles')
+
+#signals rather than save()/delete(), so bulk deletes (e.g. the admin's) clear it too
+post_save.connect(_clear_role_facet, sender=Biography, dispatch_uid='ttwr_role_facet_Biography')
+for _model in (Biography, BiographyRole):
+    post_delete.connect(_clear_role_facet, sender=_model, dispatch_uid='ttwr_role_facet_%s' % _model.__name__)
+
+
 class Essay(models.Model):
 
     slug = models.SlugField(max_length=254)
     author = models.CharField(max_length=254)
     title = models.CharField(max_length=254)
     text = models.TextField()
+    text_html = models.TextField(blank=True, editable=False) #text rendered from markdown on save
     pids = models.CharField(max_length=254, null=True, blank=True, help_text='Comma-separated list of pids for books or prints associated with this essay.')
     people = models.ManyToManyField(Biography, null=True, blank=True, help_text='List of people associated with this essay.')
 
+    def save(self, *args, **kwargs):
+        self.text_html = render_markdown(self.text)
+        super(Essay, self).save(*args, **kwargs)
+
 
 class Genre(models.Model):
     text = models.CharField(max_length=50, unique=True)
@@ -142,7 +226,511 @@ class Role(models.Model):
         return unicode(self.text)
 
 
+# People, roles & genres named in annotations, looked up in batches & kept in vocabulary_cache
+_VOCABULARY = {'person': (Biography, 'trp_id'), 'role': (Role, 'text'), 'genre': (Genre, 'text')}
+
+def normalize_trp_id(trp_id):
+    return u'%04d' % int(trp_id)
+
+def resolve_vocabulary(trp_ids=(), roles=(), genres=()):
+    '''Returns {'person': {trp_id: Biography}, 'role': {text: Role}, 'genre': {text: Genre}} for the
+    given keys, for any number of annotations at once: at most one query per model, for whatever
+    isn't cached already. Keys with no match are left out, & looked up again next time, since a
+    person or role added in another process wouldn't clear this process's cache.'''
+    wanted = {'person': set(normalize_trp_id(t) for t in trp_ids), 'role': set(roles), 'genre': set(genres)}
+    resolved = {}
+    for kind, keys in wanted.items():
+        found = {}
+        missing = []
+        for key in keys:
+            cached = vocabulary_cache.get((kind, key))
+            if cached is None:
+                missing.append(key)
+            else:
+                found[key] = cached
+        if missing:
+            model, field = _VOCABULARY[kind]
+            for obj in model.objects.filter(**{'%s__in' % field: missing}):
+                found[getattr(obj, field)] = obj
+                vocabulary_cache.set((kind, getattr(obj, field)), obj)
+        resolved[kind] = found
+    return resolved
+
+def _clear_vocabulary(sender, **kwargs):
+    #renames & new entries are rare, so any change just starts the cache over
+    vocabulary_cache.clear()
+
+for _model in (Biography, Role, Genre):
+    post_save.connect(_clear_vocabulary, sender=_model, dispatch_uid='ttwr_vocabulary_%s' % _model.__name__)
+    post_delete.connect(_clear_vocabulary, sender=_model, dispatch_uid='ttwr_vocabulary_%s' % _model.__name__)
+
+
+# Local mirror of BDR collection 621 (filled by the mirror_bdr management command)
+class MirroredObject(models.Model):
+    pid = models.CharField(max_length=64, unique=True)
+    data = models.TextField() #item json from /api/items/<pid>/
+    modified = models.CharField(max_length=40, blank=True) #last modification time in the BDR
+
+    class Meta:
+        abstract = True
+
+    def get_data(self):
+        return json.loads(self.data)
+
+    def __unicode__(self):
+        return u'%s' % self.pid
+
+
+class MirroredBook(MirroredObject):
+    pass
+
+
+class MirroredPage(MirroredObject):
+    book = models.ForeignKey(MirroredBook, related_name='pages')
+    order = models.IntegerField()
+
+    class Meta:
+        ordering = ['book', 'order']
+
+
+class MirroredPrint(MirroredObject):
+    pass
+
+
+class MirroredAnnotation(models.Model):
+    pid = models.CharField(max_length=64, unique=True)
+    target_pid = models.CharField(max_length=64, db_index=True) #the page or print it annotates
+    title = models.TextField(blank=True)
+    record = models.TextField() #parsed MODS, see mods_parser.parse_annotation
+    modified = models.CharField(max_length=40, blank=True)
+
+    def get_record(self):
+        return json.loads(self.record)
+
+    def __unicode__(self):
+        return u'%s' % self.pid
+
+
+class MirroredContributor(models.Model):
+    #one row per name in an item's solr 'name' or 'contributor' field
+    field = models.CharField(max_length=20)
+    name = models.CharField(max_length=254, db_index=True)
+    pid = models.CharField(max_length=64, db_index=True)
+
+
+class MirrorSync(models.Model):
+    started = models.DateTimeField()
+    finished = models.DateTimeField(null=True, blank=True)
+    full = models.BooleanField(default=False)
+
+    class Meta:
+        get_latest_by = 'started'
+
+
+# An annotation post or edit waiting to go to the BDR, with what's needed to send it and
+# to update the caches, mirror & person index afterwards (see outbox.py)
+class AnnotationWrite(models.Model):
+    NEW = 'new'
+    UPDATE = 'update'
+    PENDING = 'pending'
+    SENDING = 'sending'
+    DONE = 'done'
+    FAILED = 'failed' #gave up - see last_error; the drain command's --retry-failed queues it again
+    INTERRUPTED = 'interrupted' #a post cut off mid-send, which may be in the BDR already - only queued again by hand (admin)
+    KIND_CHOICES = ((NEW, 'new'), (UPDATE, 'update'))
+    STATUS_CHOICES = ((PENDING, 'pending'), (SENDING, 'sending'), (DONE, 'done'), (FAILED, 'failed'), (INTERRUPTED, 'interrupted'))
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    image_pid = models.CharField(max_length=64, db_index=True)
+    anno_pid = models.CharField(max_length=64, blank=True, db_index=True) #set when a new annotation is posted
+    book_pid = models.CharField(max_length=64, blank=True) #the page's book, for clearing its annotated pages
+    username = models.CharField(max_length=254, blank=True)
+    source = models.CharField(max_length=254, blank=True, db_index=True) #bulk imports: the file it came from, so it's only queued once
+    title = models.TextField(blank=True)
+    trp_ids = models.TextField(default='[]') #json list of the people named
+    mods_xml = models.TextField()
+    params = models.TextField() #json of the BDR post/put params, without the credentials
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True) #when pending: not before; when sending: claimed at
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u'%s %s: %s (%s)' % (self.kind, self.anno_pid or self.image_pid, self.title, self.status)
+
+
+# The BDR object holding each person's TEI, and what we know about our cached copy of it (see tei.py)
+class PersonTEI(models.Model):
+    trp_id = models.CharField(max_length=15, unique=True)
+    pid = models.CharField(max_length=64)
+    name = models.CharField(max_length=254, blank=True)
+    etag = models.CharField(max_length=64, blank=True) #md5 of the cached file, for our own conditional GETs
+    content_type = models.CharField(max_length=100, default='application/xml')
+    bdr_etag = models.CharField(max_length=254, blank=True)
+    bdr_last_modified = models.CharField(max_length=64, blank=True)
+    checked = models.DateTimeField(null=True, blank=True) #last time the BDR confirmed our copy
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.trp_id, self.pid)
+
+
+# Which book each page is in, so finding a page's book doesn't take a BDR request
+class PageParent(models.Model):
+    BATCH_SIZE = 500 #sqlite can't take much bigger IN clauses
+    page_pid = models.CharField(max_length=64, unique=True)
+    book_pid = models.CharField(max_length=64)
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.page_pid, self.book_pid)
+
+    @classmethod
+    def book_pid_for(cls, page_pid):
+        try:
+            return cls.objects.get(page_pid=page_pid).book_pid
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def record(cls, pairs, quiet=False):
+        '''Adds (page pid, book pid) pairs to the index, updating pages that moved. Read paths pass
+        <quiet>, so a failure to write the index is logged instead of failing the request.'''
+        try:
+            cls._record(pairs)
+        except Exception as e:
+            if not quiet:
+                raise
+            app_settings.logger.error(u'TTWR - error recording page parents: %s' % e)
+
+    @classmethod
+    def _record(cls, pairs):
+        parents = dict(pairs)
+        page_pids = list(parents)
+        for i in range(0, len(page_pids), cls.BATCH_SIZE):
+            batch = page_pids[i:i+cls.BATCH_SIZE]
+            known = dict(cls.objects.filter(page_pid__in=batch).values_list('page_pid', 'book_pid'))
+            new = [pid for pid in batch if pid not in known]
+            sid = transaction.savepoint()
+            try:
+                cls.objects.bulk_create([cls(page_pid=pid, book_pid=parents[pid]) for pid in new])
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                #another request (e.g. a concurrent view of the same book) recorded some of them first
+                transaction.savepoint_rollback(sid)
+                for pid in new:
+                    cls.objects.get_or_create(page_pid=pid, defaults={'book_pid': parents[pid]})
+            for pid in batch:
+                if pid in known and known[pid] != parents[pid]:
+                    cls.objects.filter(page_pid=pid).update(book_pid=parents[pid])
+
+    @classmethod
+    def record_book(cls, book_pid, book_data):
+        #book_data is the book's item json
+        cls.record((part['pid'], book_pid) for part in book_data.get('relations', {}).get('hasPart', []))
+
+
+# Books, prints & annotated pages for each person, so biography_detail doesn't search the BDR
+class PersonWorksIndex(models.Model):
+    trp_id = models.CharField(max_length=15, unique=True)
+    built = models.DateTimeField()
+
+    def __unicode__(self):
+        return u'%s' % self.trp_id
+
+    @classmethod
+    def _collect_works(cls, bio):
+        '''Everything the BDR links to <bio>, as unsaved PersonWorks; and whether every lookup worked.'''
+        books = bio.books()
+        prints_search = bio.prints()
+        failures = []
+        (pages_books, prints_mentioned) = bio.annotations_by_books_and_prints(failures=failures)
+        works = [PersonWork(kind='book', pid=book.pid, title=book.title()) for book in books]
+        #prints linked by an annotation first, then the ones that list the person as a contributor
+        works.extend(PersonWork(kind='print', pid=p.pid, title=p.title(), annotation_pid=p.data.get('annotation_pid', ''))
+                for p in prints_mentioned)
+        works.extend(PersonWork(kind='print', pid=p.pid, title=p.title()) for p in prints_search)
+        for book_id, book in pages_books.items():
+            for num, page in book['pages']:
+                works.append(PersonWork(kind='page', pid=page['rel_is_annotation_of_ssim'][0], title=page['title'],
+                        book_pid=u'%s:%s' % (app_settings.PID_PREFIX, book_id), book_title=book['title'], pagination=num,
+                        thumb=page['thumb'], annotation_pid=page['pid']))
+        return works, not failures
+
+    @classmethod
+    def _store(cls, bio, works):
+        with _atomic():
+            index, created = cls.objects.get_or_create(trp_id=bio.trp_id, defaults={'built': timezone.now()})
+            #concurrent builds for one person take turns replacing its works
+            index = cls.objects.select_for_update().get(pk=index.pk)
+            index.works.all().delete()
+            for work in works:
+                work.index = index
+            PersonWork.objects.bulk_create(works)
+            index.built = timezone.now()
+            index.save()
+        return index
+
+    @classmethod
+    def build(cls, bio):
+        '''(Re)builds the index for <bio> from the BDR. If any lookup fails, it raises & the index is
+        left as it was, so an incomplete one is never stored.'''
+        works, complete = cls._collect_works(bio)
+        if not complete:
+            raise Exception('some BDR lookups failed for %s - index not stored' % bio.trp_id)
+        return cls._store(bio, works)
+
+    @classmethod
+    def works_for(cls, bio):
+        '''(books, prints, pages_books) for biography_detail.html, from the index, which is built the first
+        time. If the BDR doesn't answer every lookup, what it did return is shown but not stored,
+        so the next view tries again.'''
+        try:
+            return cls.objects.get(trp_id=bio.trp_id).display_works()
+        except cls.DoesNotExist:
+            pass
+        works, complete = cls._collect_works(bio)
+        if complete:
+            return cls._store(bio, works).display_works()
+        app_settings.logger.error(u'TTWR - incomplete works for %s, not indexing them yet' % bio.trp_id)
+        return _display_works(works)
+
+    @classmethod
+    def annotation_saved(cls, anno_pid, image_pid, title, trp_ids):
+        '''Updates the indexes of everyone an annotation names, after it's posted or edited.
+        People who aren't indexed yet get everything when their index is built.'''
+        #an edit can drop people from the annotation, so start from scratch for it
+        PersonWork.objects.filter(annotation_pid=anno_pid).delete()
+        indexes = list(cls.objects.filter(trp_id__in=trp_ids))
+        if not indexes:
+            return
+        image = get_item(image_pid) or {}
+        parents = image.get('relations', {}).get('isPartOf') or []
+        if parents:
+            #the book's title, as build() stores (not the page's)
+            book = get_item(parents[0]['pid']) or {}
+            work = {'kind': 'page', 'pid': image_pid, 'title': title, 'book_pid': parents[0]['pid'],
+                    'book_title': get_full_title_static(book), 'thumb': Page(data={'pid': image_pid}).thumbnail_src}
+            if image.get('rel_has_pagination_ssim'):
+                work['pagination'] = int(image['rel_has_pagination_ssim'][0])
+        else:
+            work = {'kind': 'print', 'pid': image_pid, 'title': get_full_title_static(image)}
+        PersonWork.objects.bulk_create([PersonWork(index=index, annotation_pid=anno_pid, **work) for index in indexes])
+
+    def display_works(self):
+        return _display_works(self.works.order_by('id'))
+
+
+def _display_works(works):
+    '''Returns (books, prints, pages_books) in the shapes biography_detail.html expects, from PersonWorks in order.'''
+    books = []
+    prints = []
+    pages_books = {}
+    seen_prints = set()
+    for work in works:
+        if work.kind == 'book':
+            books.append(Book(data={'pid': work.pid, 'primary_title': work.title}))
+        elif work.kind == 'print':
+            if work.pid not in seen_prints:
+                seen_prints.add(work.pid)
+                prints.append(Print(data={'pid': work.pid, 'primary_title': work.title}))
+        else:
+            book_id = work.book_pid.split(u':')[-1]
+            book = pages_books.setdefault(book_id, {'pid': book_id, 'title': work.book_title, 'pages': {}})
+            book['pages'][work.pagination] = {'id': work.pid.split(u':')[-1], 'title': work.title, 'thumb': work.thumb}
+    for book in pages_books.values():
+        book['pages'] = sorted(book['pages'].items())
+    return (books, prints, pages_books)
+
+
+class PersonWork(models.Model):
+    KIND_CHOICES = (('book', 'Book'), ('print', 'Print'), ('page', 'Annotated page'))
+    index = models.ForeignKey(PersonWorksIndex, related_name='works')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    pid = models.CharField(max_length=64) #the book, print or page
+    title = models.TextField(blank=True)
+    book_pid = models.CharField(max_length=64, blank=True) #for pages
+    book_title = models.TextField(blank=True)
+    pagination = models.IntegerField(null=True, blank=True)
+    thumb = models.CharField(max_length=254, blank=True)
+    annotation_pid = models.CharField(max_length=64, blank=True, db_index=True) #the annotation linking a page/print to the person
+
+
+MIRROR_MODELS = (MirroredPage, MirroredBook, MirroredPrint)
+
+def get_item(pid):
+    '''Item json for <pid>: from the local mirror when ROME_READ_FROM_MIRROR is set and
+    the item has been mirrored, from the BDR (through the item cache) otherwise.'''
+    if app_settings.READ_FROM_MIRROR:
+        for model in MIRROR_MODELS:
+            try:
+                return model.objects.get(pid=pid).get_data()
+            except model.DoesNotExist:
+                pass
+    return bdr_client.get_item(pid)
+
+_indexed_books = set() #books whose pages this process has put in PageParent
+
+def page_order_index(book_pid, book_data=None):
+    '''{page pid: (order, previous page pid, next page pid)} for a book (None for no previous/next page),
+    cached per book. <book_data> is the book's item json, if the caller already has it.'''
+    index = page_order_cache.get(book_pid)
+    if index is None:
+        book_data = book_data or get_item(book_pid) or {}
+        parts = sorted(book_data.get('relations', {}).get('hasPart', []), key=lambda part: int(part['order']))
+        pids = [part['pid'] for part in parts]
+        index = {}
+        for i, part in enumerate(parts):
+            index[part['pid']] = (int(part['order']), pids[i-1] if i > 0 else None, pids[i+1] if i + 1 < len(pids) else None)
+        page_order_cache.set(book_pid, index)
+        PageParent.record(((pid, book_pid) for pid in pids), quiet=True)
+    return index
+
+def _annotated_in(page_pids):
+    #the ones among <page_pids> with a public annotation
+    query = u' OR '.join(u'"%s"' % pid for pid in page_pids)
+    params = {'q': u'%s AND rel_is_annotation_of_ssim:(%s)' % (Annotation.PUBLIC_QUERY, query)}
+    docs = bdr_client.iter_docs(bdr_client.search_url(), params, fields=('rel_is_annotation_of_ssim',))
+    return set(doc['rel_is_annotation_of_ssim'][0] for doc in docs if doc.get('rel_is_annotation_of_ssim'))
+
+def annotated_pids(page_pids, group_amount=50):
+    '''The pids among <page_pids> (e.g. a book's pages) that have a public annotation, from the mirror or
+    from batched BDR searches (in groups, so the URL doesn't get too long). Returns (pids, complete):
+    complete is False if a batch failed.'''
+    page_pids = list(page_pids)
+    if app_settings.READ_FROM_MIRROR:
+        annotated = set()
+        for i in range(0, len(page_pids), PageParent.BATCH_SIZE):
+            batch = page_pids[i:i+PageParent.BATCH_SIZE]
+            annotated.update(MirroredAnnotation.objects.filter(target_pid__in=batch).values_list('target_pid', flat=True))
+        return annotated, True
+    groups = [page_pids[i:i+group_amount] for i in range(0, len(page_pids), group_amount)]
+    annotated = set()
+    complete = True
+    for group, (pids, error) in zip(groups, map_with_deadline(_annotated_in, groups, app_settings.SEARCH_FETCH_DEADLINE)):
+        if error:
+            app_settings.logger.error(u'TTWR - error looking up annotated pages: %s' % error)
+            complete = False
+        else:
+            annotated.update(pids)
+    return annotated, complete
+
+PAGE_DOC_FIELDS = ('pid', 'primary_title', 'nonsort', 'object_type', 'rel_is_part_of_ssim', 'rel_has_pagination_ssim')
+
+def _search_pids(pids):
+    #the search docs needed to place each of these pages in its book (or to see it's a print)
+    query = u"(pid:" + (u" OR pid:".join(pid.replace(u':', u'\:') for pid in pids)) + u")"
+    params = {
+        'q': u'%s AND display:BDR_PUBLIC' % query,
+        'fl': bdr_client.field_list(PAGE_DOC_FIELDS),
+        'rows': len(pids),
+    }
+    return bdr_client.search(params)['response']['docs']
+
+def _book_page_docs(book_pid):
+    #the same docs as _search_pids, for every page of a book - a short query however many pages there are
+    params = {'q': u'rel_is_part_of_ssim:"%s" AND display:BDR_PUBLIC' % book_pid}
+    return list(bdr_client.iter_docs(bdr_client.search_url(), params, fields=PAGE_DOC_FIELDS, cached=True))
+
+def _indexed_page_docs(pids):
+    '''Builds the same docs as _search_pids for the pages PageParent knows the book of, with one
+    search per book, run concurrently. Returns (docs, pids still to look up, pids whose book's search failed).
+    Pages that aren't in their indexed book any more are among the ones still to look up.'''
+    books = {}
+    for i in range(0, len(pids), PageParent.BATCH_SIZE):
+        batch = pids[i:i+PageParent.BATCH_SIZE]
+        for page_pid, book_pid in PageParent.objects.filter(page_pid__in=batch).values_list('page_pid', 'book_pid'):
+            books.setdefault(book_pid, set()).add(page_pid)
+    docs = []
+    found = set()
+    failed = set()
+    book_pids = list(books)
+    for book_pid, (book_docs, error) in zip(book_pids, map_with_deadline(_book_page_docs, book_pids, app_settings.SEARCH_FETCH_DEADLINE)):
+        if error:
+            app_settings.logger.error(u'TTWR - error looking up the pages of %s: %s' % (book_pid, error))
+            failed.update(books[book_pid])
+            continue
+        for doc in book_docs:
+            if doc['pid'] in books[book_pid]:
+                docs.append(doc)
+                found.add(doc['pid'])
+    return docs, [pid for pid in pids if pid not in found and pid not in failed], sorted(failed)
+
+def _mirrored_page_docs(pids):
+    '''Builds the same docs as _search_pids from the mirror, for the pids it has.
+    Returns (docs, pids the mirror doesn't have).'''
+    if not app_settings.READ_FROM_MIRROR or not pids:
+        return [], pids
+    docs = []
+    found = set()
+    for i in range(0, len(pids), 500): #keep the IN clauses a reasonable size
+        group = pids[i:i+500]
+        for page in MirroredPage.objects.filter(pid__in=group).select_related('book'):
+            data = page.get_data()
+            doc = dict((k, data[k]) for k in ('pid', 'primary_title', 'nonsort') if k in data)
+            doc['rel_is_part_of_ssim'] = [page.book.pid]
+            doc['rel_has_pagination_ssim'] = data.get('rel_has_pagination_ssim', [page.order])
+            docs.append(doc)
+            found.add(page.pid)
+        for print_obj in MirroredPrint.objects.filter(pid__in=group):
+            data = print_obj.get_data()
+            docs.append(dict((k, data[k]) for k in ('pid', 'primary_title', 'nonsort') if k in data))
+            found.add(print_obj.pid)
+    return docs, [pid for pid in pids if pid not in found]
+
+def get_mirrored_annotation_record(pid):
+    if app_settings.READ_FROM_MIRROR:
+        try:
+            return MirroredAnnotation.objects.get(pid=pid).get_record()
+        except MirroredAnnotation.DoesNotExist:
+            pass
+    return None
+
+
+def _mirrored_docs(objects, fields=None):
+    #one at a time, rather than every object's json at once
+    for obj in objects.iterator():
+        doc = obj.get_data()
+        if fields:
+            #same fields as the BDR would give, so what works on one works on the other
+            doc = dict((f, doc[f]) for f in fields if f in doc)
+        yield doc
+
+
 # Non-Database Models
+_warned_fields = set()
+
+class _ProjectedData(dict):
+    '''Stands in for the data of an object searched for with a field list, when DEBUG_PROJECTION
+    is on: logs (once) any use of a field that wasn't asked for, which would otherwise just look missing.'''
+
+    def __init__(self, data, fields, owner):
+        dict.__init__(self, data)
+        self._fields = frozenset(fields)
+        self._owner = owner
+
+    def _check(self, key):
+        if key in self._fields or key.startswith('_') or (self._owner, key) in _warned_fields:
+            return
+        _warned_fields.add((self._owner, key))
+        app_settings.logger.warning(u'TTWR - %s field "%s" used, but not in the search fields (%s)' % (self._owner, key, u','.join(sorted(self._fields))))
+
+    def __getitem__(self, key):
+        self._check(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self._check(key)
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self._check(key)
+        return dict.get(self, key, default)
+
+
 class BDRObject(object):
     def __init__(self, data=None, parent=None):
         self.data= data or {}
@@ -166,23 +754,54 @@ class BDRObject(object):
         return item in self.data
 
     OBJECT_TYPE = "*"
+    MIRROR_MODEL = None #table holding these objects in the local mirror
+    MIRROR_QUERY = "*" #the query whose results the mirror holds
+    TITLE_FIELDS = ('pid', 'primary_title', 'nonsort') #enough for links to objects
     @classmethod
-    def search(cls, query="*", rows=6000):
-        url1 = 'https://%s/api/collections/621/?q=%s&fq=object_type:%s&fl=*&fq=discover:BDR_PUBLIC&rows=%s' % (app_settings.BDR_SERVER, query, cls.OBJECT_TYPE, rows)
-        objects_json = json.loads(requests.get(url1).text)
-        num_objects = objects_json['items']['numFound']
-        if num_objects>rows: #only reload if we need to find more bdr_objects
-            return cls.search(query, num_objects)
-        return [ cls(data=obj_data) for obj_data in objects_json['items']['docs'] ]
+    def _search_params(cls, query, fields=None):
+        return {'q': query, 'fq': ['object_type:%s' % cls.OBJECT_TYPE, 'discover:BDR_PUBLIC'], 'fl': bdr_client.field_list(fields)}
 
+    @classmethod
+    def _from_doc(cls, data, fields=None):
+        if fields and app_settings.DEBUG_PROJECTION:
+            data = _ProjectedData(data, fields, cls.__name__)
+        return cls(data=data)
+
+    @classmethod
+    def mirror_search(cls, query, fields=None):
+        #the mirror can answer the queries the site runs itself: everything, or a name/contributor match.
+        #returns None for anything else, so it goes to the BDR
+        if not app_settings.READ_FROM_MIRROR or cls.MIRROR_MODEL is None:
+            return None
+        objects = cls.MIRROR_MODEL.objects.all()
+        if query not in ('*', cls.MIRROR_QUERY):
+            match = re.match(r'^(name|contributor):"(.*)"$', query)
+            if not match:
+                return None
+            pids = MirroredContributor.objects.filter(field=match.group(1), name=match.group(2)).values_list('pid', flat=True)
+            objects = objects.filter(pid__in=list(pids))
+        return _mirrored_docs(objects, fields)
+
+    @classmethod
+    def search_iter(cls, query="*", chunk_size=app_settings.SEARCH_CHUNK_SIZE, fields=None, cached=True):
+        '''Yields the objects matching <query>. Pass the <fields> the caller uses, rather than
+        getting every field of every object; pass cached=False to stream a big result set.'''
+        docs = cls.mirror_search(query, fields)
+        if docs is None:
+            docs = bdr_client.iter_docs(bdr_client.collection_url(), cls._search_params(query, fields), chunk_size, cached=cached)
+        for obj_data in docs:
+            yield cls._from_doc(obj_data, fields)
+
+    @classmethod
+    def search(cls, query="*", fields=None):
+        return list(cls.search_iter(query, fields=fields))
 
     @classmethod
     def get(cls, pid):
-        json_uri='https://%s/api/items/%s/?q=*&fl=*' % (app_settings.BDR_SERVER, pid)
-        resp = requests.get(json_uri)
-        if not resp.ok:
+        data = get_item(pid)
+        if data is None:
              return cls()
-        return cls(data=json.loads(resp.text))
+        return cls(data=data)
 
     @classmethod
     def get_or_404(cls, pid):
@@ -215,11 +834,13 @@ class BDRObject(object):
         return self.data['primary_title']
 
     def sort_key(self, sort_by):
+        #nonsort articles aren't in primary_title, and collation_key takes care of accents & case
+        title = collation_key(self.title_sort())
         if(sort_by == 'title_sort'):
-            return (self.title_sort(), self.date())
+            return (title, self.date())
         elif(sort_by == 'authors'):
-            return (self.authors(), self.title_sort(), self.date())
-        return (self.date(), self.title_sort())
+            return (collation_key(self.authors()), title, self.date())
+        return (self.date(), title)
 
     def alt_titles(self):
         if "mods_title_alt" in self.data:
@@ -246,6 +867,11 @@ from django.utils.datastructures import SortedDict
 # Book
 class Book(BDRObject):
     OBJECT_TYPE = "implicit-set"
+    MIRROR_MODEL = MirroredBook
+    MIRROR_QUERY = "genre_aat:books*"
+    #what BookRecord & the sort keys use
+    LIST_FIELDS = ('pid', 'uri', 'primary_title', 'nonsort', 'partnumber', 'name', 'mods_title_alt',
+            'dateCreated', 'dateIssued', 'contributor_display')
     CUTOFF = 80
     SORT_OPTIONS = SortedDict([
         ( 'authors', 'authors' ),
@@ -273,7 +899,33 @@ class Book(BDRObject):
         return 'https://%s/viewers/readers/set/%s/' % (app_settings.BDR_SERVER, self.pid)
 
     def pages(self):
-        return [ Page(data=page_data, parent=self) for page_data in self.relations['hasPart'] ]
+        pages = [ Page(data=page_data, parent=self) for page_data in self.relations['hasPart'] ]
+        if self.pid not in _indexed_books:
+            PageParent.record(((page.pid, self.pid) for page in pages), quiet=True)
+            _indexed_books.add(self.pid)
+        return pages
+
+    @classmethod
+    def sorted_collection(cls):
+        '''Every book, in each of the SORT_OPTIONS orders; rebuilt when the search results are
+        refreshed, or after a mirror sync.'''
+        def build():
+            docs = (book.data for book in cls.search_iter(cls.MIRROR_QUERY, fields=cls.LIST_FIELDS, cached=False))
+            sort_keys = dict((opt, lambda doc, opt=opt: cls(data=doc).sort_key(opt)) for opt in cls.SORT_OPTIONS.values())
+            return SortedCollection(docs, sort_keys, record=lambda doc: BookRecord(cls(data=doc)))
+        return get_sorted('books', build)
+
+    def annotated_page_ids(self):
+        #cached per book (if every lookup worked); outbox._after_write drops the entry when an annotation is added
+        key = ('book', self.pid)
+        page_ids = annotated_cache.get(key)
+        if page_ids is None:
+            pages = self.pages()
+            (annotated, complete) = annotated_pids(page.pid for page in pages)
+            page_ids = set(page.id for page in pages if page.pid in annotated)
+            if complete:
+                annotated_cache.set(key, page_ids)
+        return page_ids
 
 
 # Page
@@ -294,23 +946,94 @@ class Page(BDRObject):
 # Print
 class Print(Page):
     OBJECT_TYPE = "image-compound"
+    MIRROR_MODEL = MirroredPrint
+    #everything on the print list
+    LIST_QUERY = 'ir_collection_id:%s AND (genre_aat:"etchings (prints)" OR genre_aat:"engravings (prints)")' % app_settings.BDR_COLLECTION_ID
+    MIRROR_QUERY = LIST_QUERY
+    #what PrintRecord, the sort keys & the print list's facets use
+    LIST_FIELDS = ('pid', 'primary_title', 'nonsort', 'subtitle', 'dateCreated', 'dateIssued', 'contributor_display', 'contributor', 'genre_aat')
 
     def url(self):
         return reverse('specific_print', args=[self.id,])
 
+# Compact rows for the list views: only what the list templates show, worked out once,
+# so a cached list doesn't hold every object's whole solr doc
+class _Record(object):
+    __slots__ = ()
+
+    #pickle (for the django cache backends) needs these with __slots__
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class BookRecord(_Record):
+    __slots__ = ('pid', 'id', 'title', 'short_title', 'title_cut', 'primary_title', 'partnumber', 'name',
+            'date', 'authors', 'alt_titles', 'thumbnail_url', 'studio_uri')
+
+    def __init__(self, book):
+        self.pid = book.pid
+        self.id = book.id
+        self.title = book.title()
+        self.short_title = book.short_title
+        self.title_cut = book.title_cut()
+        self.primary_title = book.title_sort()
+        self.partnumber = book.data.get('partnumber')
+        self.name = book.data.get('name', [])
+        self.date = book.date()
+        self.authors = book.authors()
+        self.alt_titles = book.alt_titles()
+        self.thumbnail_url = book.thumbnail_url
+        self.studio_uri = book.data.get('uri')
+
+
+class PrintRecord(_Record):
+    __slots__ = ('pid', 'id', 'title', 'short_title', 'title_cut', 'primary_title', 'date', 'authors',
+            'in_chinea', 'thumbnail_url', 'studio_uri', 'det_img_viewer')
+    CUTOFF = 60
+
+    def __init__(self, data, in_chinea=False):
+        self.pid = data['pid']
+        self.id = self.pid.split(":")[1]
+        self.title = get_full_title_static(data)
+        self.title_cut = len(self.title) > self.CUTOFF
+        self.short_title = self.title[0:self.CUTOFF-3]+"..." if self.title_cut else self.title
+        self.primary_title = data.get('primary_title', self.title)
+        if 'dateCreated' in data:
+            self.date = data['dateCreated'][0:4]
+        elif 'dateIssued' in data:
+            self.date = data['dateIssued'][0:4]
+        else:
+            self.date = "n.d."
+        self.authors = "; ".join(data['contributor_display'] if 'contributor_display' in data else data.get('contributor', ["Unknown"]))
+        self.in_chinea = in_chinea
+        self.thumbnail_url = reverse('specific_print', args=[self.id])
+        self.studio_uri = 'https://%s/studio/item/%s/' % (app_settings.BDR_SERVER, self.pid)
+        self.det_img_viewer = 'https://%s/viewers/image/zoom/%s' % (app_settings.BDR_SERVER, self.pid)
+
+
 class Annotation(object):
+    #every annotation in the collection
+    COLLECTION_QUERY = 'ir_collection_id:%s AND object_type:"annotation"' % app_settings.BDR_COLLECTION_ID
+    PUBLIC_QUERY = COLLECTION_QUERY + ' AND display:BDR_PUBLIC'
 
     @classmethod
     def from_form_data(cls, image_pid, annotator, form_data, person_formset_data, inscription_formset_data, pid=None):
         return cls(image_pid=image_pid, annotator=annotator, pid=pid, form_data=form_data, person_formset_data=person_formset_data, inscription_formset_data=inscription_formset_data)
 
     @classmethod
-    def from_pid(cls, pid):
-        r = requests.get('%s%s/' % (app_settings.BDR_ANNOTATION_URL, pid))
-        if not r.ok:
-            raise Exception('error retrieving annotation data for %s: %s - %s' % (pid, r.status_code, r.content))
-        mods_obj = load_xmlobject_from_string(r.content, mods.Mods)
-        return cls(pid=pid, mods_obj=mods_obj)
+    def from_pid(cls, pid, image_pid=None, mods_xml=None):
+        #<mods_xml> is for an edit that's still in the outbox, which the BDR doesn't have yet
+        if not mods_xml:
+            r = bdr_client.get_mods(pid)
+            if not r.ok:
+                raise Exception('error retrieving annotation data for %s: %s - %s' % (pid, r.status_code, r.content))
+            mods_xml = r.content
+        mods_obj = load_xmlobject_from_string(mods_xml, mods.Mods)
+        return cls(image_pid=image_pid, pid=pid, mods_obj=mods_obj)
 
     def __init__(self, image_pid=None, annotator=None, pid=None, form_data=None, person_formset_data=[], inscription_formset_data=[], mods_obj=None):
         self._image_pid = image_pid #pid of the object that we're adding the annotation for
@@ -341,7 +1064,10 @@ class Annotation(object):
             if len(self._mods_obj.title_info_list) > 1:
                 self._form_data['english_title'] = self._mods_obj.title_info_list[1].title
             if self._mods_obj.genres and self._mods_obj.genres[0].text:
-                genre = Genre.objects.get(text=self._mods_obj.genres[0].text)
+                genre_text = self._mods_obj.genres[0].text
+                genre = resolve_vocabulary(genres=[genre_text])['genre'].get(genre_text)
+                if not genre:
+                    raise Exception('no genre %s' % genre_text)
                 self._form_data['genre'] = genre.id
             if self._mods_obj.abstract:
                 self._form_data['abstract'] = self._mods_obj.abstract.text
@@ -355,19 +1081,16 @@ class Annotation(object):
             if not self._mods_obj:
                 raise Exception('no person formset data or mods obj')
             self._person_formset_data = []
-            for name in self._mods_obj.names:
-                p = {}
-                trp_id = name.node.get('{%s}href' % app_settings.XLINK_NAMESPACE)
-                trp_id = '%04d' % int(trp_id)
-                try:
-                    person = Biography.objects.get(trp_id=trp_id)
-                except:
+            names = [(normalize_trp_id(name.node.get('{%s}href' % app_settings.XLINK_NAMESPACE)), name.roles[0].text)
+                    for name in self._mods_obj.names]
+            #everyone & every role in one go, rather than two queries per name
+            vocabulary = resolve_vocabulary(trp_ids=[n[0] for n in names], roles=[n[1] for n in names])
+            for trp_id, role_text in names:
+                if trp_id not in vocabulary['person']:
                     raise Exception('no person with trp_id %s' % trp_id)
-                p['person'] = person
-                role_text = name.roles[0].text
-                role = Role.objects.get(text=role_text)
-                p['role'] = role
-                self._person_formset_data.append(p)
+                if role_text not in vocabulary['role']:
+                    raise Exception('no role %s' % role_text)
+                self._person_formset_data.append({'person': vocabulary['person'][trp_id], 'role': vocabulary['role'][role_text]})
         return self._person_formset_data
 
     def get_inscription_formset_data(self):
@@ -462,18 +1185,58 @@ class Annotation(object):
             raise Exception('no pid for annotation update')
         return params
 
+    def person_trp_ids(self):
+        return [p['person'].trp_id for p in self._person_formset_data]
+
+    def write_fields(self, update=False):
+        '''The AnnotationWrite fields for sending this annotation to the BDR later.'''
+        params = self._get_update_params() if update else self._get_params()
+        #the credentials come from the settings when it's sent, rather than sitting in the db
+        del params['identity']
+        del params['authorization_code']
+        #the params built the mods, so don't build (& add an annotator note to) them again
+        return {'params': json.dumps(params), 'mods_xml': self.to_mods_xml(), 'title': self._form_data['title'],
+                'trp_ids': json.dumps(self.person_trp_ids())}
+
+    @staticmethod
+    def _update_person_index(pid, image_pid, title, trp_ids):
+        #the write itself went through, so a failure here is only logged
+        try:
+            PersonWorksIndex.annotation_saved(pid, image_pid, title, trp_ids)
+        except Exception as e:
+            app_settings.logger.error(u'TTWR - error updating person index for annotation %s: %s' % (pid, e))
+
+    @staticmethod
+    def posted(pid, image_pid, title, trp_ids):
+        '''Brings the item cache & person index up to date after a new annotation is posted.
+        With the 'local' cache backend, only this process's item cache is cleared (see caches.make_cache).'''
+        #the image's item json now lists a new annotation
+        bdr_client.invalidate_item(image_pid)
+        Annotation._update_person_index(pid, image_pid, title, trp_ids)
+
+    @staticmethod
+    def updated(pid, image_pid, title, trp_ids):
+        '''Same as posted(), after an annotation is edited.'''
+        bdr_client.invalidate_item(pid)
+        if image_pid:
+            bdr_client.invalidate_item(image_pid)
+            Annotation._update_person_index(pid, image_pid, title, trp_ids)
+
     def save_to_bdr(self):
         params = self._get_params()
-        r = requests.post(app_settings.BDR_POST_URL, data=params)
+        r = bdr_client.post(app_settings.BDR_POST_URL, data=params)
         if r.ok:
-            return {'pid': json.loads(r.text)['pid']}
+            pid = json.loads(r.text)['pid']
+            Annotation.posted(pid, self._image_pid, self._form_data['title'], self.person_trp_ids())
+            return {'pid': pid}
         else:
             raise Exception('error posting new annotation for %s: %s - %s' % (self._image_pid, r.status_code, r.content))
 
     def update_in_bdr(self):
         params = self._get_update_params()
-        r = requests.put(app_settings.BDR_POST_URL, data=params)
+        r = bdr_client.put(app_settings.BDR_POST_URL, data=params)
         if r.ok:
+            Annotation.updated(self._pid, self._image_pid, self._form_data['title'], self.person_trp_ids())
             return {'status': 'success'}
         else:
             raise Exception('error putting update to %s: %s - %s' % (self._pid, r.status_code, r.content))
@@ -0,0 +1,133 @@
+from io import BytesIO
+from operator import itemgetter
+import xml.etree.ElementTree as ET
+from . import app_settings
+
+MODS = '{http://www.loc.gov/mods/v3}'
+XLINK_HREF = '{%s}href' % app_settings.XLINK_NAMESPACE
+
+
+def _title(curr_annot, elem):
+    text = elem[0].text if len(elem) else None
+    if elem.get('lang') == 'en':
+        curr_annot['title'] = text
+    else:
+        curr_annot['orig_title'] = text
+    curr_annot['has_elements']['title'] += 1
+
+def _name(curr_annot, elem):
+    curr_annot['names'].append({
+        'name': elem[0].text,
+        'role': elem[1][0].text.capitalize() if(elem[1][0].text) else "Contributor",
+        'trp_id': "%04d" % int(elem.get(XLINK_HREF)),
+    })
+
+def _abstract(curr_annot, elem):
+    curr_annot['abstract'] = elem.text
+    curr_annot['has_elements']['abstract'] = 1
+
+def _genre(curr_annot, elem):
+    curr_annot['genre'] = elem.text
+    curr_annot['has_elements']['genre'] = 1
+
+def _origin_info(curr_annot, elem):
+    for impression in elem.iter(MODS + 'dateOther'):
+        curr_annot['impression'] = impression.text
+        if impression.text is not None:
+            curr_annot['has_elements']['impression'] = 1
+
+def _note(curr_annot, elem):
+    if not elem.text:
+        return
+    note_type = elem.get('type', '').lower()
+    if note_type == 'inscription':
+        curr_annot['inscriptions'].append(u'%s: %s' % (elem.get('displayLabel', ''), elem.text))
+        curr_annot['has_elements']['inscriptions'] = 1
+    elif note_type == 'annotation':
+        curr_annot['annotations'].append(u'%s: %s' % (elem.get('displayLabel', ''), elem.text))
+        curr_annot['has_elements']['annotations'] = 1
+    elif note_type == 'resp':
+        #display for the first annotator; ignore later annotators for now
+        if not curr_annot['annotator']:
+            curr_annot['annotator'] = elem.text
+            curr_annot['has_elements']['annotator'] = 1
+
+_HANDLERS = {
+    MODS + 'titleInfo': _title,
+    MODS + 'name': _name,
+    MODS + 'abstract': _abstract,
+    MODS + 'genre': _genre,
+    MODS + 'originInfo': _origin_info,
+    MODS + 'note': _note,
+}
+
+
+def _xml_source(source):
+    #mods read back from the db is unicode, which BytesIO won't take
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    if isinstance(source, str):
+        source = BytesIO(source)
+    return source
+
+
+def parse_annotation(source):
+    '''Builds the annotation record shown on the page/print views from a MODS document,
+    in one pass over it. <source> is the xml as a byte or unicode string, or a file-like object.'''
+    source = _xml_source(source)
+    curr_annot = {
+        'has_elements': {'inscriptions':0, 'annotations':0, 'annotator':0, 'origin':0, 'title':0, 'abstract':0, 'genre':0},
+        'names': [],
+        'inscriptions': [],
+        'annotations': [],
+        'annotator': '',
+    }
+    for event, elem in ET.iterparse(source):
+        handler = _HANDLERS.get(elem.tag)
+        if handler:
+            handler(curr_annot, elem)
+            #nothing we handle is nested in something else we handle, so the subtree can go
+            elem.clear()
+    curr_annot['names'] = sorted(curr_annot['names'], key=itemgetter("role", "name"))
+    return curr_annot
+
+
+def _text(elem):
+    return (elem.text or u'').strip() if elem is not None else u''
+
+def parse_annotation_fields(source):
+    '''For importing annotations made elsewhere: the values the annotation form would have had for
+    a MODS document (read the way Annotation.get_form_data reads them), with the people as
+    {'trp_id', 'role'} and the inscriptions as {'text', 'location'}. 'identifiers' are the document's
+    own identifiers and 'host_identifiers' its host relatedItem's, each as {type: value}.'''
+    source = _xml_source(source)
+    root = ET.parse(source).getroot()
+    fields = {'title': u'', 'title_language': u'', 'english_title': u'', 'genre': u'', 'abstract': u'',
+              'impression_date': u'', 'people': [], 'inscriptions': [], 'annotator': u'',
+              'identifiers': {}, 'host_identifiers': {}}
+    title_infos = root.findall(MODS + 'titleInfo')
+    if title_infos:
+        fields['title'] = _text(title_infos[0].find(MODS + 'title'))
+        fields['title_language'] = title_infos[0].get('lang', u'')
+    if len(title_infos) > 1:
+        fields['english_title'] = _text(title_infos[1].find(MODS + 'title'))
+    fields['genre'] = _text(root.find(MODS + 'genre'))
+    fields['abstract'] = _text(root.find(MODS + 'abstract'))
+    for date in root.iter(MODS + 'dateOther'):
+        if date.get('type') == 'impression' and _text(date):
+            fields['impression_date'] = _text(date)
+    for name in root.findall(MODS + 'name'):
+        fields['people'].append({'trp_id': name.get(XLINK_HREF, u''), 'role': _text(name.find(MODS + 'role/' + MODS + 'roleTerm'))})
+    for note in root.findall(MODS + 'note'):
+        note_type = note.get('type', '').lower()
+        if note_type == 'inscription' and _text(note):
+            fields['inscriptions'].append({'text': _text(note), 'location': note.get('displayLabel', u'')})
+        elif note_type == 'resp' and _text(note) and not fields['annotator']:
+            fields['annotator'] = _text(note)
+    for identifier in root.findall(MODS + 'identifier'):
+        fields['identifiers'][identifier.get('type', u'')] = _text(identifier)
+    for related in root.findall(MODS + 'relatedItem'):
+        if related.get('type') == 'host':
+            for identifier in related.iter(MODS + 'identifier'):
+                fields['host_identifiers'][identifier.get('type', u'')] = _text(identifier)
+    return fields
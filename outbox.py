@@ -0,0 +1,181 @@
+'''Outbox for annotation posts & edits.
+
+The annotation views save an AnnotationWrite and redirect straight away, instead of waiting
+on the BDR. Writes are sent by send(): right away in the background (OUTBOX_SEND_NOW), and by
+the drain_annotation_writes command, which retries failures with exponential backoff and leaves
+a write as failed after OUTBOX_MAX_ATTEMPTS. Once a write lands, the same caches, mirror &
+person index updates as before happen (see _after_write).
+'''
+import json
+from datetime import timedelta
+from django.db import connection
+from django.utils import timezone
+from . import app_settings, bdr_client, mirror
+from .app_settings import logger
+from .caches import annotation_cache, annotated_cache
+from .concurrency import get_pool
+from .models import Annotation, AnnotationWrite
+from .mods_parser import parse_annotation
+
+
+def queue_new(annotation, image_pid, username, book_pid='', send_now=True, source=''):
+    '''<send_now>=False leaves the write for the caller (e.g. a bulk import) or the drain command to send.
+    <source> is the file a bulk import read it from.'''
+    write = AnnotationWrite.objects.create(kind=AnnotationWrite.NEW, image_pid=image_pid, book_pid=book_pid,
+            username=username, source=source, **annotation.write_fields())
+    if send_now:
+        _send_soon(write.pk)
+    return write
+
+def queue_update(annotation, anno_pid, image_pid, username):
+    write = AnnotationWrite.objects.create(kind=AnnotationWrite.UPDATE, anno_pid=anno_pid, image_pid=image_pid,
+            username=username, **annotation.write_fields(update=True))
+    _send_soon(write.pk)
+    return write
+
+def _send_soon(pk):
+    if app_settings.OUTBOX_SEND_NOW:
+        #not the shared fetch pool: after a write, the mirror update fetches on that pool, & waiting
+        #on it from one of its own threads can deadlock
+        get_pool('outbox', app_settings.OUTBOX_SEND_WORKERS).apply_async(_send_in_background, (pk,))
+
+def _send_in_background(pk):
+    try:
+        send(pk)
+    except Exception as e:
+        logger.error(u'TTWR - error sending annotation write %s: %s' % (pk, e))
+    finally:
+        connection.close() #pool threads outlive the request, so don't leave a connection open
+
+
+def _claim(pk):
+    #only one sender gets a write, so a new annotation can't be posted twice
+    now = timezone.now()
+    return AnnotationWrite.objects.filter(pk=pk, status=AnnotationWrite.PENDING, next_attempt__lte=now).update(
+            status=AnnotationWrite.SENDING, next_attempt=now) == 1
+
+def _waiting_on_earlier(write):
+    #edits of one annotation go in the order they were made (given up ones don't hold later ones back)
+    if write.kind != AnnotationWrite.UPDATE:
+        return False
+    return AnnotationWrite.objects.filter(anno_pid=write.anno_pid, id__lt=write.id,
+            status__in=[AnnotationWrite.PENDING, AnnotationWrite.SENDING]).exists()
+
+def send(pk):
+    '''Sends the AnnotationWrite <pk> if it's due & no one else is sending it. Returns True if it landed.'''
+    if not _claim(pk):
+        return False
+    write = AnnotationWrite.objects.get(pk=pk)
+    if _waiting_on_earlier(write):
+        #_send_waiting sends it once the earlier edit is finished with
+        AnnotationWrite.objects.filter(pk=pk).update(status=AnnotationWrite.PENDING)
+        return False
+    try:
+        pid = _write_to_bdr(write)
+    except Exception as e:
+        _failed(write, e)
+        if write.status == AnnotationWrite.FAILED:
+            _send_waiting(write)
+        return False
+    write.anno_pid = pid
+    write.status = AnnotationWrite.DONE
+    write.attempts += 1
+    write.last_error = ''
+    write.finished = timezone.now()
+    write.save()
+    logger.info(u'%s %s annotation %s for %s' % (write.username, 'added' if write.kind == AnnotationWrite.NEW else 'edited', pid, write.image_pid))
+    _after_write(write)
+    _send_waiting(write)
+    return True
+
+def _send_waiting(write):
+    #the next edit of the same annotation, held back by _waiting_on_earlier, can go now
+    if write.kind != AnnotationWrite.UPDATE:
+        return
+    waiting = AnnotationWrite.objects.filter(anno_pid=write.anno_pid, kind=AnnotationWrite.UPDATE, id__gt=write.id,
+            status=AnnotationWrite.PENDING).order_by('id')[:1]
+    for later in waiting:
+        _send_soon(later.pk)
+
+def _write_to_bdr(write):
+    params = json.loads(write.params)
+    params.update({'identity': app_settings.BDR_IDENTITY, 'authorization_code': app_settings.BDR_AUTH_CODE})
+    if write.kind == AnnotationWrite.NEW:
+        r = bdr_client.post(app_settings.BDR_POST_URL, data=params)
+        if not r.ok:
+            raise Exception('error posting new annotation for %s: %s - %s' % (write.image_pid, r.status_code, r.content))
+        return json.loads(r.text)['pid']
+    r = bdr_client.put(app_settings.BDR_POST_URL, data=params)
+    if not r.ok:
+        raise Exception('error putting update to %s: %s - %s' % (write.anno_pid, r.status_code, r.content))
+    return write.anno_pid
+
+def _after_write(write):
+    #the write went through, so a failure here is only logged
+    try:
+        trp_ids = json.loads(write.trp_ids)
+        if write.kind == AnnotationWrite.NEW:
+            Annotation.posted(write.anno_pid, write.image_pid, write.title, trp_ids)
+            annotation_cache.set(write.anno_pid, json.dumps(parse_annotation(write.mods_xml), separators=(',', ':')))
+        else:
+            Annotation.updated(write.anno_pid, write.image_pid, write.title, trp_ids)
+            annotation_cache.delete(write.anno_pid)
+        if write.book_pid:
+            annotated_cache.delete(('book', write.book_pid))
+        if app_settings.READ_FROM_MIRROR:
+            mirror.annotation_written(write.anno_pid, write.image_pid, write.mods_xml)
+    except Exception as e:
+        logger.error(u'TTWR - error updating caches after annotation write %s: %s' % (write.pk, e))
+
+def _failed(write, error):
+    write.attempts += 1
+    write.last_error = u'%s' % error
+    if write.attempts >= app_settings.OUTBOX_MAX_ATTEMPTS:
+        write.status = AnnotationWrite.FAILED
+        logger.error(u'TTWR - giving up on annotation write %s after %s attempts: %s' % (write.pk, write.attempts, error))
+    else:
+        write.status = AnnotationWrite.PENDING
+        delay = min(app_settings.OUTBOX_RETRY_BACKOFF * 2 ** (write.attempts - 1), app_settings.OUTBOX_MAX_BACKOFF)
+        write.next_attempt = timezone.now() + timedelta(seconds=delay)
+        logger.warning(u'TTWR - annotation write %s failed (attempt %s), retrying in %ss: %s' % (write.pk, write.attempts, delay, error))
+    write.save()
+
+
+def release_interrupted():
+    '''Deals with writes left sending by a process that died: edits are queued again (putting the
+    same mods twice is harmless), but a new annotation may already be in the BDR, so it's marked
+    interrupted, for someone to check & queue again from the admin. Returns how many writes were released.'''
+    cutoff = timezone.now() - timedelta(seconds=app_settings.OUTBOX_SEND_TIMEOUT)
+    stuck = AnnotationWrite.objects.filter(status=AnnotationWrite.SENDING, next_attempt__lt=cutoff)
+    count = stuck.filter(kind=AnnotationWrite.UPDATE).update(status=AnnotationWrite.PENDING)
+    count += stuck.filter(kind=AnnotationWrite.NEW).update(status=AnnotationWrite.INTERRUPTED,
+            last_error=u'interrupted while posting - check the BDR for the annotation before retrying')
+    return count
+
+def retry_failed():
+    '''Queues the failed writes again, with a fresh set of attempts. Interrupted posts aren't
+    included - they could duplicate an annotation (see requeue).'''
+    return requeue(AnnotationWrite.objects.filter(status=AnnotationWrite.FAILED))
+
+def requeue(writes):
+    '''Queues the failed or interrupted writes among <writes> (a queryset) again, with a fresh set of attempts.'''
+    return writes.filter(status__in=[AnnotationWrite.FAILED, AnnotationWrite.INTERRUPTED]).update(
+            status=AnnotationWrite.PENDING, attempts=0, next_attempt=timezone.now())
+
+def drain(limit=None):
+    '''Sends the writes that are due, oldest first. Returns (tried, landed).'''
+    due = AnnotationWrite.objects.filter(status=AnnotationWrite.PENDING, next_attempt__lte=timezone.now())
+    pks = list(due.values_list('pk', flat=True)[:limit] if limit else due.values_list('pk', flat=True))
+    landed = len([pk for pk in pks if send(pk)])
+    return (len(pks), landed)
+
+
+def unfinished_for(image_pid):
+    '''The writes for an image that haven't landed yet, for showing on its page.'''
+    return list(AnnotationWrite.objects.filter(image_pid=image_pid).exclude(status=AnnotationWrite.DONE))
+
+def latest_mods(anno_pid):
+    '''The mods of the latest edit of <anno_pid> that hasn't landed yet, or None.'''
+    writes = AnnotationWrite.objects.filter(anno_pid=anno_pid, kind=AnnotationWrite.UPDATE).exclude(status=AnnotationWrite.DONE)
+    write = writes.order_by('-id')[:1]
+    return write[0].mods_xml if write else None
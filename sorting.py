@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import unicodedata
+from .caches import collection_cache
+
+#letters NFKD doesn't take apart
+_EXPANSIONS = {u'æ': u'ae', u'œ': u'oe', u'ß': u'ss', u'ø': u'o', u'ł': u'l', u'đ': u'd'}
+_LEADING_PUNCTUATION = u' "\'«»“”‘’[(¿¡-'
+
+
+def collation_key(text):
+    '''Sort key for titles & names: accents, case and leading quotes/brackets don't change the order,
+    so "Église" sorts with "eglise" and "Ça" with "ca" (the original text breaks ties).'''
+    text = u'%s' % (text or u'')
+    folded = u''.join(c for c in unicodedata.normalize('NFKD', text.lower()) if not unicodedata.combining(c))
+    folded = u''.join(_EXPANSIONS.get(c, c) for c in folded)
+    return (folded.lstrip(_LEADING_PUNCTUATION), text)
+
+
+def _bitset(indices, size):
+    #int with bit i set for each i in <indices>, built in one go rather than OR by OR
+    bits = bytearray(b'0' * size)
+    for i in indices:
+        bits[size - 1 - i] = ord(b'1')
+    return int(str(bits), 2) if size else 0
+
+def bit_positions(bitset):
+    '''The indices of the bits set in <bitset>, lowest first.'''
+    bits = bin(bitset)[:1:-1] #lowest bit first, without the '0b'
+    positions = []
+    i = bits.find('1')
+    while i != -1:
+        positions.append(i)
+        i = bits.find('1', i + 1)
+    return positions
+
+
+class FacetIndex(object):
+    '''For each facet (e.g. 'decade'), {value: bitset of the docs with that value}; the bitsets
+    are python ints, bit i standing for doc i. Filters & counts are bitwise operations on them.'''
+
+    def __init__(self, docs_values, size):
+        '''<docs_values> is a list of {facet: [values]}, one per doc.'''
+        indices = {}
+        for i, facet_values in enumerate(docs_values):
+            for facet, values in facet_values.items():
+                for value in values:
+                    indices.setdefault(facet, {}).setdefault(value, []).append(i)
+        self.size = size
+        self.all = (1 << size) - 1
+        self.facets = dict((facet, dict((value, _bitset(members, size)) for value, members in values.items()))
+                for facet, values in indices.items())
+
+    def select(self, selected):
+        '''Bitset of the docs matching <selected>, {facet: [values]}: any of the values
+        chosen for a facet, and every facet chosen.'''
+        mask = self.all
+        for facet, values in selected.items():
+            facet_mask = 0
+            for value in values:
+                facet_mask |= self.facets.get(facet, {}).get(value, 0)
+            mask &= facet_mask
+        return mask
+
+    COUNTS_MEMO_SIZE = 256
+
+    def counts(self, selected):
+        '''{facet: [(value, count)]} for <selected> ({facet: [values]}), most common first; values with
+        no docs are left out. Each facet is counted among the docs matching the *other* facets'
+        choices, so the rest of a facet's values stay listed (& choosable) once one is chosen.
+        Counts are memoized per selection.'''
+        key = tuple(sorted((facet, tuple(sorted(set(values)))) for facet, values in selected.items() if values))
+        memo = self.__dict__.setdefault('_counts_memo', {})
+        counts = memo.get(key)
+        if counts is None:
+            counts = {}
+            for facet, values in self.facets.items():
+                mask = self.select(dict((f, v) for f, v in key if f != facet))
+                facet_counts = [(value, bin(bits & mask).count('1')) for value, bits in values.items()]
+                counts[facet] = sorted([vc for vc in facet_counts if vc[1]], key=lambda vc: (-vc[1], vc[0]))
+            if len(memo) >= self.COUNTS_MEMO_SIZE:
+                memo.clear()
+            memo[key] = counts
+        return counts
+
+    def __getstate__(self):
+        #the memo is rebuilt as it's used, so it isn't pickled with the index
+        state = dict(self.__dict__)
+        state.pop('_counts_memo', None)
+        return state
+
+
+class SortedCollection(object):
+    '''A collection's docs, with their order under every sort option worked out up front
+    as lists of indices, so a sorted page is just a slice; optionally with a FacetIndex.'''
+
+    def __init__(self, docs, sort_keys, record=None, facets=None):
+        '''<docs> can be any iterable (a stream of search results, say): each doc is read once.
+        <sort_keys> maps each sort option to a key function on docs. If <record> is given, only
+        record(doc) is kept of each doc. <facets>(doc) gives a doc's {facet: [values]}.
+        Only records, orders & facet bitsets are kept, so it pickles.'''
+        self.docs = []
+        keys = dict((sort_name, []) for sort_name in sort_keys)
+        facet_values = []
+        for doc in docs:
+            for sort_name, key in sort_keys.items():
+                keys[sort_name].append(key(doc))
+            if facets:
+                facet_values.append(facets(doc))
+            self.docs.append(record(doc) if record else doc)
+        self.orders = {}
+        for sort_name in sort_keys:
+            self.orders[sort_name] = sorted(range(len(self.docs)), key=keys[sort_name].__getitem__)
+        self.facet_index = FacetIndex(facet_values, len(self.docs)) if facets else None
+
+    def sorted_view(self, sort_name, make=None, mask=None):
+        '''The docs in <sort_name> order; just the ones in the <mask> bitset, if it's given.'''
+        order = self.orders[sort_name]
+        if mask is not None:
+            members = set(bit_positions(mask))
+            order = [i for i in order if i in members]
+        return SortedView(self.docs, order, make)
+
+
+class SortedView(object):
+    '''Read-only sequence of the docs in one order. Only the items actually looked up
+    (e.g. the current page, for a Paginator) are turned into objects, by make(doc) if it's given.'''
+
+    def __init__(self, docs, order, make):
+        self.docs = docs
+        self.order = order
+        self.make = make
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        make = self.make or (lambda doc: doc)
+        if isinstance(index, slice):
+            return [make(self.docs[i]) for i in self.order[index]]
+        return make(self.docs[self.order[index]])
+
+
+def get_sorted(name, build):
+    '''The SortedCollection cached under <name>. build() makes it when it's missing, and again
+    in the background once it's stale (see StaleWhileRevalidateCache).'''
+    return collection_cache.get_or_fetch(('sorted', name), build)
+
+def invalidate(name):
+    collection_cache.delete(('sorted', name))
@@ -13,35 +13,6 @@ function expand_title(page_num,num_on_page)
     document.getElementById(page_num+"_"+num_on_page+"_full").style.display="inline";
 }
 
-function expand_buttons() {
-    var page_buttons = $(".page_button");
-
-    for (var i = 0; i < page_buttons.length; i++) {
-        var pagenum = parseInt($(page_buttons[i]).text())
-
-        var items = $("#page_" + pagenum + " ul li span.sort_by_field");
-        var first_item = $(items[0]).text().trim().split(" ")[0].replace(",", "");
-        var last_item_initial = $(items[items.length - 1]).text().trim();
-
-        /*
-        Options for this problem:
-        Ignore no data items (A-Z)
-        Include no data items (A-n.d.)
-        Include both (A-Z and n.d.)
-        */
-
-        var n = 2;
-        while(last_item_initial.lastIndexOf("not available") != -1) {
-            last_item_initial = $(items[items.length - n]).text().trim();
-            n++;
-        }
-
-        var last_item = last_item_initial.split(" ")[0].replace(",", "");
-
-        $(page_buttons[i]).text(first_item + " — " + last_item);
-    };
-}
-
 function hover_show(id) {
     $("#"+id+" div.extra").fadeTo(500, 1);
 }
@@ -50,24 +21,17 @@ function hover_hide(id) {
     $("#"+id+" div.extra").fadeTo(500, 0);
 }
 
-function show_page(i)
+function load_more(link)
 {
-    var old_page, new_page, buttons;
-    old_page=document.getElementById("page_"+curr_page);
-    old_page.style.display="none";
-    
-    new_page=document.getElementById("page_"+i);
-    new_page.style.display="block";
-    curr_page=i;
-    
-    buttons=document.getElementsByClassName("page_button");
-    for(var j=0;j<buttons.length;j++)
-        buttons[j].style.background="#aaaaaa"
-    buttons[parseInt(i)-1].style.background='#888888';
-    
-    document.getElementById("prints_shown").innerHTML=((parseInt(i)-1)*prints_per_page+1)+"-"+(Math.min(parseInt(i)*prints_per_page, max_num));
-    
-    document.getElementById("curr_page_span").innerHTML=i;
+    // fetch just the next page's results and put them (and its own "load more" link) in place of this link
+    var href = $(link).attr("href");
+    $(link).text("Loading...");
+    $.get(href + (href.indexOf("?") == -1 ? "?" : "&") + "fragment=1", function(html) {
+        $(link).replaceWith(html);
+    }).fail(function() {
+        window.location = href;
+    });
+    return false;
 }
 
 function show_sorting(sorting)
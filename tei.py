@@ -0,0 +1,102 @@
+'''On-disk cache of the people's TEI datastreams.
+
+PersonTEI maps each trp_id to the BDR object with the person's TEI, so that's only searched
+for once. The TEI itself is kept in TEI_CACHE_DIR; once a copy is older than TEI_REVALIDATE_AFTER
+it's revalidated with a conditional GET (the BDR's ETag / Last-Modified), so an unchanged file
+costs a 304 rather than a download.
+'''
+import os
+import hashlib
+import tempfile
+from datetime import timedelta
+from django.utils import timezone
+from . import app_settings, bdr_client
+from .app_settings import logger
+from .models import PersonTEI
+
+
+def _find_pid(trp_id):
+    params = {'q': u'mods_id_trp_ssim:trp-%s AND display:BDR_PUBLIC' % trp_id, 'fl': 'pid,name'}
+    docs = bdr_client.search(params)['response']['docs']
+    if not docs:
+        return None, None
+    name = docs[0].get('name') or u''
+    return docs[0]['pid'], name[0] if isinstance(name, list) else name
+
+def get_entry(trp_id):
+    '''The PersonTEI for <trp_id> (4 digits), searching the BDR the first time; None if there's no TEI object.'''
+    try:
+        return PersonTEI.objects.get(trp_id=trp_id)
+    except PersonTEI.DoesNotExist:
+        pid, name = _find_pid(trp_id)
+        if not pid:
+            return None
+        entry, created = PersonTEI.objects.get_or_create(trp_id=trp_id, defaults={'pid': pid, 'name': name})
+        return entry
+
+def path_for(entry):
+    return os.path.join(app_settings.TEI_CACHE_DIR, u'%s.xml' % entry.pid.replace(u':', u'_'))
+
+def _write(path, r):
+    #to a temp file that replaces the old copy in one step, so readers never see half a file
+    if not os.path.isdir(app_settings.TEI_CACHE_DIR):
+        os.makedirs(app_settings.TEI_CACHE_DIR)
+    md5 = hashlib.md5()
+    f = tempfile.NamedTemporaryFile(dir=app_settings.TEI_CACHE_DIR, delete=False)
+    try:
+        for chunk in r.iter_content(64 * 1024):
+            md5.update(chunk)
+            f.write(chunk)
+        f.close()
+        os.rename(f.name, path)
+    except Exception:
+        f.close()
+        os.remove(f.name)
+        raise
+    return md5.hexdigest()
+
+def refresh(entry):
+    '''Makes sure the cached file for <entry> is usable, revalidating it if it's due.
+    Returns False if the BDR no longer has the TEI. If the BDR can't be reached, a copy we
+    already have is still served; with no copy, raises an Exception.'''
+    path = path_for(entry)
+    have_copy = os.path.exists(path)
+    if have_copy and entry.checked and timezone.now() - entry.checked < timedelta(seconds=app_settings.TEI_REVALIDATE_AFTER):
+        return True
+    headers = {}
+    if have_copy:
+        if entry.bdr_etag:
+            headers['If-None-Match'] = entry.bdr_etag
+        if entry.bdr_last_modified:
+            headers['If-Modified-Since'] = entry.bdr_last_modified
+    try:
+        r = bdr_client.get(bdr_client.datastream_url(entry.pid, 'TEI'), headers=headers, stream=True)
+    except Exception as e:
+        if not have_copy:
+            raise
+        logger.error(u'TTWR - error revalidating TEI for %s, serving the cached copy: %s' % (entry.trp_id, e))
+        return True
+    try:
+        if r.status_code == 304 and have_copy:
+            pass
+        elif r.ok:
+            entry.etag = _write(path, r)
+            entry.content_type = r.headers.get('Content-Type') or 'application/xml'
+            entry.bdr_etag = r.headers.get('ETag', '')
+            entry.bdr_last_modified = r.headers.get('Last-Modified', '')
+        elif r.status_code == 404:
+            #gone from the BDR - forget it, so the next request searches again
+            entry.delete()
+            if have_copy:
+                os.remove(path)
+            return False
+        elif have_copy:
+            logger.error(u'TTWR - error revalidating TEI for %s, serving the cached copy: %s' % (entry.trp_id, r.status_code))
+            return True
+        else:
+            raise Exception('error retrieving TEI for %s: %s' % (entry.trp_id, r.status_code))
+    finally:
+        r.close()
+    entry.checked = timezone.now()
+    entry.save()
+    return True
@@ -1,16 +1,438 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import json
+import pickle
+import time
+from datetime import timedelta
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import timezone
+from io import BytesIO
+from StringIO import StringIO
+from . import app_settings, bdr_client, outbox
+from .concurrency import map_with_deadline
+from .mods_parser import parse_annotation
+from .sorting import FacetIndex, SortedCollection, collation_key, get_sorted, invalidate
+from .views import _paginate
+from .caches import DjangoCache, LocalCache, StaleWhileRevalidateCache, annotation_cache, annotated_cache
+from .management.commands.import_annotations import _read_checkpoint, _target_pid
+from .models import AnnotationWrite, Biography, BiographyRole, Role, PageParent, PersonWork, PersonWorksIndex, _indexed_page_docs
 
-Replace this with more appropriate tests for your application.
-"""
+TEST_MODS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.xml')
 
-from django.test import TestCase
 
+def _mods_text():
+    with open(TEST_MODS, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.fail = False
+        self.real = (outbox._write_to_bdr, app_settings.OUTBOX_SEND_NOW)
+        outbox._write_to_bdr = self.fake_write
+        app_settings.OUTBOX_SEND_NOW = False
+
+    def tearDown(self):
+        outbox._write_to_bdr, app_settings.OUTBOX_SEND_NOW = self.real
+
+    def fake_write(self, write):
+        self.sent.append(write.pk)
+        if self.fail:
+            raise Exception('BDR down')
+        return write.anno_pid or 'test:new%s' % write.pk
+
+    def _write(self, **fields):
+        values = {'kind': AnnotationWrite.NEW, 'image_pid': 'test:page', 'title': u'B\xe9n\xe9diction',
+                  'mods_xml': _mods_text(), 'params': '{}'}
+        values.update(fields)
+        return AnnotationWrite.objects.create(**values)
+
+    def test_after_write_with_mods_from_the_db(self):
+        pk = self._write(anno_pid='test:anno', book_pid='test:book', status=AnnotationWrite.DONE).pk
+        annotated_cache.set(('book', 'test:book'), ['test:other'])
+        write = AnnotationWrite.objects.get(pk=pk) #mods_xml comes back as unicode
+        self.assertTrue(isinstance(write.mods_xml, unicode))
+        outbox._after_write(write)
+        record = json.loads(annotation_cache.get('test:anno'))
+        self.assertEqual(record['orig_title'], u"B\xe9n\xe9diction del Bambino de l'Araceli, au capitole")
+        self.assertEqual(annotated_cache.get(('book', 'test:book')), None)
+
+    def test_a_write_is_sent_once(self):
+        write = self._write()
+        self.assertTrue(outbox.send(write.pk))
+        self.assertFalse(outbox.send(write.pk))
+        self.assertEqual(self.sent, [write.pk])
+        write = AnnotationWrite.objects.get(pk=write.pk)
+        self.assertEqual((write.status, write.anno_pid, write.attempts), (AnnotationWrite.DONE, 'test:new%s' % write.pk, 1))
+
+    def test_not_sent_before_its_next_attempt(self):
+        write = self._write(next_attempt=timezone.now() + timedelta(minutes=5))
+        self.assertFalse(outbox.send(write.pk))
+        self.assertEqual(outbox.drain(), (0, 0))
+        self.assertEqual(self.sent, [])
+
+    def test_failures_back_off_then_give_up(self):
+        self.fail = True
+        write = self._write()
+        before = timezone.now()
+        self.assertFalse(outbox.send(write.pk))
+        write = AnnotationWrite.objects.get(pk=write.pk)
+        self.assertEqual((write.status, write.attempts, write.last_error), (AnnotationWrite.PENDING, 1, 'BDR down'))
+        self.assertTrue(write.next_attempt >= before + timedelta(seconds=app_settings.OUTBOX_RETRY_BACKOFF))
+        AnnotationWrite.objects.filter(pk=write.pk).update(attempts=app_settings.OUTBOX_MAX_ATTEMPTS - 1, next_attempt=timezone.now())
+        outbox.send(write.pk)
+        self.assertEqual(AnnotationWrite.objects.get(pk=write.pk).status, AnnotationWrite.FAILED)
+        self.assertEqual(outbox.retry_failed(), 1)
+        self.assertEqual(AnnotationWrite.objects.get(pk=write.pk).attempts, 0)
+
+    def test_edits_go_in_order(self):
+        first = self._write(kind=AnnotationWrite.UPDATE, anno_pid='test:anno')
+        second = self._write(kind=AnnotationWrite.UPDATE, anno_pid='test:anno')
+        self.assertFalse(outbox.send(second.pk)) #held back behind the first
+        self.assertEqual(AnnotationWrite.objects.get(pk=second.pk).status, AnnotationWrite.PENDING)
+        self.assertEqual(outbox.drain(), (2, 2))
+        self.assertEqual(self.sent, [first.pk, second.pk])
+
+    def test_release_interrupted(self):
+        long_ago = timezone.now() - timedelta(seconds=app_settings.OUTBOX_SEND_TIMEOUT + 60)
+        post = self._write(status=AnnotationWrite.SENDING, next_attempt=long_ago)
+        edit = self._write(kind=AnnotationWrite.UPDATE, anno_pid='test:anno', status=AnnotationWrite.SENDING, next_attempt=long_ago)
+        current = self._write(status=AnnotationWrite.SENDING)
+        self.assertEqual(outbox.release_interrupted(), 2)
+        statuses = dict(AnnotationWrite.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {post.pk: AnnotationWrite.INTERRUPTED, edit.pk: AnnotationWrite.PENDING, current.pk: AnnotationWrite.SENDING})
+        #a post that may be in the BDR already is only queued again by hand
+        self.assertEqual(outbox.retry_failed(), 0)
+        self.assertEqual(outbox.requeue(AnnotationWrite.objects.filter(pk=post.pk)), 1)
+
+
+class DjangoCacheTest(TestCase):
+
+    def test_str_and_unicode_pids_are_one_key(self):
+        cache = DjangoCache('test')
+        cache.set('test:1', 'a')
+        self.assertEqual(cache.get(u'test:1'), 'a')
+        cache.set((u'book', u'test:2'), 'b')
+        self.assertEqual(cache.get(('book', 'test:2')), 'b')
+        cache.delete(('book', 'test:2'))
+        self.assertEqual(cache.get((u'book', u'test:2')), None)
+
+
+class RoleFacetTest(TestCase):
+
+    def test_cleared_by_saves_and_bulk_deletes(self):
+        Biography.objects.create(name=u'Piranesi', trp_id=u'0001', roles=u'Artist; Engraver', bio=u'')
+        self.assertEqual(BiographyRole.facet_values(), [u'Artist', u'Engraver'])
+        Biography.objects.create(name=u'Vasi', trp_id=u'0002', roles=u'Publisher', bio=u'')
+        self.assertEqual(BiographyRole.facet_values(), [u'Artist', u'Engraver', u'Publisher'])
+        Biography.objects.filter(trp_id=u'0001').delete() #what the admin's "delete selected" does
+        self.assertEqual(BiographyRole.facet_values(), [u'Publisher'])
+
+
+class MapWithDeadlineTest(TestCase):
+
+    def test_results_and_errors_in_order(self):
+        def invert(n):
+            return 1.0 / n
+        results = map_with_deadline(invert, [1, 0, 4], 5)
+        self.assertEqual([r for r, e in results], [1.0, None, 0.25])
+        self.assertTrue(isinstance(results[1][1], ZeroDivisionError))
+        self.assertEqual(results[0][1], None)
+
+
+class _FakeResponse(object):
+    ok = True
+    status_code = 200
+
+    def __init__(self, body):
+        self.text = body.decode('utf-8') if isinstance(body, str) else body
+        self.content = self.text.encode('utf-8')
+        self.raw = BytesIO(self.content)
+
+    def close(self):
+        pass
+
+
+class FakeBDRTestCase(TestCase):
+    '''Answers bdr_client's requests with respond(url, params) instead of the BDR.'''
+
+    def setUp(self):
+        cache.clear()
+        self.requests = []
+        self.real_get = bdr_client.get
+        bdr_client.get = self.fake_get
+
+    def tearDown(self):
+        bdr_client.get = self.real_get
+
+    def fake_get(self, url, params=None, stream=False):
+        self.requests.append(params)
+        return _FakeResponse(self.respond(url, params))
+
+
+class IterChunksTest(FakeBDRTestCase):
+    DOCS = [{'pid': 'test:%s' % i} for i in range(5)]
+
+    def respond(self, url, params):
+        #a server that caps rows at 2, & sends numFound after the docs
+        start, rows = int(params.get('start', 0)), min(int(params['rows']), 2)
+        docs = json.dumps(self.DOCS[start:start + rows])
+        return '{"response": {"start": %s, "docs": %s, "numFound": %s}}' % (start, docs, len(self.DOCS))
+
+    def test_reads_past_short_chunks_without_a_count_request(self):
+        url = bdr_client.search_url()
+        docs = list(bdr_client.iter_docs(url, {'q': '*'}, chunk_size=3))
+        self.assertEqual(docs, self.DOCS)
+        self.assertEqual([p['start'] for p in self.requests], [0, 2, 4])
+        self.assertTrue(all(p['sort'] == 'pid asc' for p in self.requests))
+
+
+class IndexedPageDocsTest(FakeBDRTestCase):
+    BOOK_PAGES = {
+        'test:book1': [{'pid': 'test:p1', 'rel_is_part_of_ssim': ['test:book1'], 'rel_has_pagination_ssim': ['1']},
+                       {'pid': 'test:p2', 'rel_is_part_of_ssim': ['test:book1'], 'rel_has_pagination_ssim': ['2']},
+                       {'pid': 'test:other', 'rel_is_part_of_ssim': ['test:book1'], 'rel_has_pagination_ssim': ['3']}],
+        'test:book2': [],
+    }
+
+    def respond(self, url, params):
+        book_pid = params['q'].split('"')[1]
+        docs = self.BOOK_PAGES[book_pid]
+        return json.dumps({'response': {'numFound': len(docs), 'docs': docs}})
+
+    def test_one_search_per_indexed_book(self):
+        PageParent.record([('test:p1', 'test:book1'), ('test:p2', 'test:book1'), ('test:p3', 'test:book2')])
+        docs, rest, failed = _indexed_page_docs(['test:p1', 'test:p2', 'test:p3', 'test:p4'])
+        self.assertEqual(sorted(doc['pid'] for doc in docs), ['test:p1', 'test:p2'])
+        #p3 isn't in the book the index says any more, & p4 isn't indexed
+        self.assertEqual(rest, ['test:p3', 'test:p4'])
+        self.assertEqual(failed, [])
+        self.assertEqual(len(self.requests), 2)
+        self.assertTrue(all('pid:' not in p['q'] for p in self.requests))
+
+
+class PersonWorksIndexTest(TestCase):
+
+    def test_store_replaces_the_works(self):
+        bio = Biography.objects.create(name=u'Piranesi', trp_id=u'0001', bio=u'')
+        PersonWorksIndex._store(bio, [PersonWork(kind='book', pid='test:1', title=u'Vedute')])
+        index = PersonWorksIndex._store(bio, [PersonWork(kind='print', pid='test:2', title=u'Carceri')])
+        self.assertEqual(PersonWorksIndex.objects.count(), 1)
+        self.assertEqual(list(index.works.values_list('pid', flat=True)), ['test:2'])
+
+
+class ParseAnnotationTest(TestCase):
+
+    def check_record(self, record):
+        self.assertEqual(record['orig_title'], u"B\xe9n\xe9diction del Bambino de l'Araceli, au capitole")
+        self.assertEqual(record['title'].strip(), u'Blessing of the Christ Child at the Araceli Church, in the Capitol')
+        self.assertEqual([(n['role'], n['trp_id']) for n in record['names']], [(u'Artist', '0128'), (u'Lithographer', '0129')])
+        self.assertEqual(len(record['inscriptions']), 4)
+        self.assertEqual(record['annotator'], u'Sarah Reusche')
+        self.assertEqual(record['has_elements']['title'], 2)
+
+    def test_bytes(self):
+        self.check_record(parse_annotation(_mods_text().encode('utf-8')))
+
+    def test_unicode(self):
+        self.check_record(parse_annotation(_mods_text()))
+
+    def test_file(self):
+        with open(TEST_MODS, 'rb') as f:
+            self.check_record(parse_annotation(f))
+
+
+class SortingTest(TestCase):
+    DOCS = [{'title': u'\xc9glise', 'date': 3}, {'title': u'"Arco"', 'date': 1}, {'title': u'eglise', 'date': 2},
+            {'title': u'\xc6dicula', 'date': 4}]
+
+    def collection(self):
+        return SortedCollection(iter(self.DOCS), {'title': lambda d: collation_key(d['title']), 'date': lambda d: d['date']})
+
+    def test_collation_key(self):
+        titles = sorted((d['title'] for d in self.DOCS), key=collation_key)
+        self.assertEqual(titles, [u'\xc6dicula', u'"Arco"', u'eglise', u'\xc9glise'])
+
+    def test_sorted_views(self):
+        collection = self.collection()
+        self.assertEqual([d['date'] for d in collection.sorted_view('date')], [1, 2, 3, 4])
+        view = collection.sorted_view('title', make=lambda d: d['date'])
+        self.assertEqual(len(view), 4)
+        self.assertEqual(view[0], 4)
+        self.assertEqual(view[1:3], [1, 2])
+        #just docs 0 & 2
+        self.assertEqual(list(collection.sorted_view('date', mask=0b101)), [self.DOCS[2], self.DOCS[0]])
+
+    def test_get_sorted_builds_once_until_invalidated(self):
+        builds = []
+        def build():
+            builds.append(1)
+            return self.collection()
+        invalidate('test')
+        get_sorted('test', build)
+        get_sorted('test', build)
+        self.assertEqual(len(builds), 1)
+        invalidate('test')
+        get_sorted('test', build)
+        self.assertEqual(len(builds), 2)
+        invalidate('test')
+
+
+class LocalCacheTest(TestCase):
+
+    def test_least_recently_used_goes_first(self):
+        cache = LocalCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_entries_expire(self):
+        cache = LocalCache(timeout=0.01)
+        cache.set('a', 1)
+        cache.set('b', 2, timeout=60)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a', 'gone'), 'gone')
+        self.assertEqual(cache.get('b'), 2)
+        self.assertTrue(cache.add('a', 3))
+        self.assertFalse(cache.add('a', 4))
+        self.assertEqual(cache.get('a'), 3)
+
+
+class SearchKeyTest(TestCase):
+
+    def test_same_search_same_key(self):
+        url = bdr_client.search_url()
+        key = bdr_client.search_key(url, {'q': 'object_type:"annotation"  AND pid:1', 'fl': 'pid,primary_title', 'fq': ['b', 'a']})
+        self.assertEqual(key, bdr_client.search_key(url, {'fq': ('a', 'b'), 'fl': 'primary_title, pid', 'q': 'object_type:"annotation" AND pid:1'}))
+        self.assertNotEqual(key, bdr_client.search_key(url, {'q': 'object_type:"annotation" AND pid:2', 'fl': 'pid,primary_title', 'fq': ['a', 'b']}))
+
+
+class StaleWhileRevalidateTest(TestCase):
+
+    def test_serves_stale_while_refreshing(self):
+        fetches = []
+        def fetch():
+            fetches.append(1)
+            return len(fetches)
+        cache = StaleWhileRevalidateCache(LocalCache(), soft_ttl=0, hard_ttl=60)
+        self.assertEqual(cache.get_or_fetch('key', fetch), 1)
+        time.sleep(0.01)
+        self.assertEqual(cache.get_or_fetch('key', fetch), 1) #stale, & a refresh starts
+        for i in range(100):
+            if cache.backend.get('key')[0] == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get_or_fetch('key', fetch), 2)
+
+    def test_waits_for_the_fetch_after_the_hard_ttl(self):
+        cache = StaleWhileRevalidateCache(LocalCache(), soft_ttl=0.01, hard_ttl=0.01)
+        self.assertEqual(cache.get_or_fetch('key', lambda: 1), 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get_or_fetch('key', lambda: 2), 2)
+
+
+class PaginateTest(TestCase):
+    NAMES = [u'Adam, Robert', u'Barbault, Jean', u'Canova', u'Duflos, Claude', u'Piranesi, Giovanni']
+
+    def test_page_links_labelled_with_their_first_and_last(self):
+        context = {}
+        request = RequestFactory().get('/', {'page': '2', 'sort_by': 'name', 'fragment': '1'})
+        page = _paginate(request, self.NAMES, 2, context, label=lambda name: name)
+        self.assertEqual(list(page.object_list), [u'Canova', u'Duflos, Claude'])
+        self.assertEqual(context['page_links'], [(1, u'Adam \u2014 Barbault'), (2, u'Canova \u2014 Duflos'), (3, u'Piranesi \u2014 Piranesi')])
+        self.assertEqual(context['query_string'], 'sort_by=name')
+        self.assertEqual(context['base_template'], 'rome_templates/result_fragment.html')
+
+    def test_out_of_range_pages(self):
+        context = {}
+        self.assertEqual(_paginate(RequestFactory().get('/', {'page': '9'}), self.NAMES, 2, context).number, 3)
+        self.assertEqual(_paginate(RequestFactory().get('/', {'page': 'x'}), self.NAMES, 2, context).number, 1)
+        self.assertEqual(context['page_links'], [(1, 1), (2, 2), (3, 3)])
+
+
+class FacetIndexTest(TestCase):
+    DOCS = [{'genre': ['Church'], 'decade': ['1750']}, {'genre': ['Church', 'Ruin'], 'decade': ['1760']},
+            {'genre': ['Ruin'], 'decade': ['1750']}, {'genre': [], 'decade': ['1770']}]
+
+    def setUp(self):
+        self.index = FacetIndex(self.DOCS, len(self.DOCS))
+
+    def test_select(self):
+        self.assertEqual(self.index.select({}), 0b1111)
+        self.assertEqual(self.index.select({'genre': ['Church', 'Ruin']}), 0b0111)
+        self.assertEqual(self.index.select({'genre': ['Ruin'], 'decade': ['1750']}), 0b0100)
+        self.assertEqual(self.index.select({'genre': ['Fountain']}), 0)
+
+    def test_counts_leave_out_the_facets_own_choice(self):
+        counts = self.index.counts({'genre': ['Ruin']})
+        #every genre is still counted, among all the docs; decades only among the ruins
+        self.assertEqual(counts['genre'], [('Church', 2), ('Ruin', 2)])
+        self.assertEqual(counts['decade'], [('1750', 1), ('1760', 1)])
+        self.assertTrue(self.index.counts({'genre': ['Ruin']}) is counts) #memoized
+
+    def test_pickles_without_the_memo(self):
+        self.index.counts({})
+        copy = pickle.loads(pickle.dumps(self.index, 2))
+        self.assertFalse(hasattr(copy, '_counts_memo'))
+        self.assertEqual(copy.counts({}), self.index.counts({}))
+
+
+class ImportAnnotationsTest(FakeBDRTestCase):
+
+    def setUp(self):
+        super(ImportAnnotationsTest, self).setUp()
+        self.real_send = outbox.send
+        outbox.send = lambda pk: False #leave the writes queued
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, 'mods')
+        os.mkdir(self.source)
+        for name in ('a.xml', 'b.xml'):
+            shutil.copy(TEST_MODS, os.path.join(self.source, name))
+        self.targets = os.path.join(self.dir, 'targets.csv')
+        with open(self.targets, 'wb') as f:
+            f.write('a.xml,test:page1\nb,test:page2\n')
+        Biography.objects.create(name=u'Thomas', trp_id=u'0128', bio=u'')
+        Biography.objects.create(name=u'Villain', trp_id=u'0129', bio=u'')
+        Role.objects.create(text=u'Artist')
+        Role.objects.create(text=u'Lithographer')
+
+    def tearDown(self):
+        outbox.send = self.real_send
+        shutil.rmtree(self.dir)
+        super(ImportAnnotationsTest, self).tearDown()
+
+    def respond(self, url, params):
+        return '{"pid": "%s"}' % url.rstrip('/').split('/')[-1] #every target exists
+
+    def run_import(self):
+        call_command('import_annotations', self.source, targets=self.targets, rate=0, workers=2, stdout=StringIO())
+        return _read_checkpoint(self.source + '.checkpoint')
+
+    def test_target_pid(self):
+        fields = {'identifiers': {'vjb': 'thomas0055-1'}, 'host_identifiers': {'cdiobjid': '1127'}}
+        self.assertEqual(_target_pid('dir/a.xml', fields, {'a': 'test:1'}), 'test:1')
+        self.assertEqual(_target_pid('a.xml', fields, {'thomas0055-1': 'test:2'}), 'test:2')
+        self.assertEqual(_target_pid('a.xml', fields, {}), None)
+        fields['host_identifiers']['bdr'] = 'test:3'
+        self.assertEqual(_target_pid('a.xml', fields, {}), 'test:3')
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+    def test_resumes_without_queueing_twice(self):
+        queued = self.run_import()
+        self.assertEqual(sorted(queued), [u'a.xml', u'b.xml'])
+        writes = AnnotationWrite.objects.order_by('image_pid')
+        self.assertEqual([(w.image_pid, w.source) for w in writes], [('test:page1', 'mods/a.xml'), ('test:page2', 'mods/b.xml')])
+        #a crash after queueing, before the checkpoint lines were written
+        os.remove(self.source + '.checkpoint')
+        self.assertEqual(self.run_import(), queued)
+        #& a plain re-run skips what the checkpoint has
+        self.assertEqual(self.run_import(), queued)
+        self.assertEqual(AnnotationWrite.objects.count(), 2)
@@ -1,26 +1,32 @@
 # -*- coding: utf-8 -*-
 
-from django.http import HttpResponse, HttpResponseNotFound, HttpResponseServerError, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseServerError, HttpResponseRedirect, HttpResponseNotModified, StreamingHttpResponse
 from django.forms.formsets import formset_factory
 from django.template import Context, loader, RequestContext
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.paginator import Paginator
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.shortcuts import render
 from django.template.response import SimpleTemplateResponse
 from django.utils.html import escape, escapejs
+from django.utils.http import http_date, parse_http_date_safe
 from django.contrib.auth.decorators import login_required
 
+import os
 import json
-from operator import itemgetter, methodcaller
-import xml.etree.ElementTree as ET
+from operator import itemgetter, attrgetter
 import re
-import requests
-from .models import Biography, Essay, Book, Annotation, Page
-from .app_settings import BDR_SERVER, BOOKS_PER_PAGE, PID_PREFIX, logger
+from wsgiref.util import FileWrapper
+from . import bdr_client, outbox, tei
+from .caches import annotation_cache
+from .concurrency import map_with_deadline
+from .mods_parser import parse_annotation
+from .sorting import collation_key, SortedCollection, get_sorted
+from .models import Biography, BiographyRole, Essay, Book, Annotation, Page, Print, PrintRecord, PageParent, PersonWorksIndex, get_item, page_order_index, get_mirrored_annotation_record, resolve_vocabulary
+from .app_settings import BDR_SERVER, BOOKS_PER_PAGE, PID_PREFIX, ANNOTATION_FETCH_DEADLINE, ITEM_FETCH_DEADLINE, logger
 
 def annotation_order(s): 
-    retval = re.sub("[^0-9]", "", first_word(s['orig_title']))
+    retval = re.sub("[^0-9]", "", first_word(s.get('orig_title', '')))
     return int(retval) if retval != '' else 0
     
 
@@ -59,32 +65,57 @@ def index(request):
     return HttpResponse(template.render(c))
 
 
+def _label_word(value):
+    return (u'%s' % value).strip().split(u' ')[0].replace(u',', u'', 1)
+
+def _paginate(request, items, per_page, context, label=None):
+    '''Puts just the requested page of <items> in the context, with links to the others.
+    Each link is labelled with the first & last sort values on its page, if <label> gives them.
+    With ?fragment=1 the list templates render only the results (for "load more").'''
+    paginator = Paginator(items, per_page)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    params = request.GET.copy()
+    for name in ('page', 'fragment'):
+        params.pop(name, None)
+
+    page_links = []
+    for i in paginator.page_range:
+        if label is None or not paginator.count:
+            page_links.append((i, i))
+            continue
+        start = (i - 1) * per_page
+        last = min(start + per_page, paginator.count) - 1
+        page_links.append((i, u'%s \u2014 %s' % (_label_word(label(items[start])), _label_word(label(items[last])))))
+
+    context['PAGIN'] = paginator
+    context['page_obj'] = page
+    context['num_pages'] = paginator.num_pages
+    context['page_links'] = page_links
+    context['curr_page'] = page.number
+    context['num_results'] = paginator.count
+    context['results_per_page'] = per_page
+    context['query_string'] = params.urlencode()
+    if request.GET.get('fragment'):
+        context['base_template'] = 'rome_templates/result_fragment.html'
+    return page
+
+
 def book_list(request):
     context = std_context(request.path, )
-    book_list = Book.search(query="genre_aat:books*")
-
     sort_by = request.GET.get('sort_by', 'title')
     sort_by = Book.SORT_OPTIONS.get(sort_by, 'title_sort')
-    book_list=sorted(book_list,key=methodcaller('sort_key', sort_by))
-
-    page = request.GET.get('page', 1)
-    PAGIN=Paginator(book_list, BOOKS_PER_PAGE);
-
-    page_list = []
-    for i in PAGIN.page_range:
-        page_list.append(PAGIN.page(i).object_list)
+    book_list = Book.sorted_collection().sorted_view(sort_by)
 
-    context['num_pages']=PAGIN.num_pages
-    context['page_range']=PAGIN.page_range
-    context['PAGIN']=PAGIN
+    label = attrgetter('primary_title' if sort_by == 'title_sort' else sort_by)
+    _paginate(request, book_list, BOOKS_PER_PAGE, context, label=label)
 
     context['sorting'] = sort_by
     context['sort_options'] = Book.SORT_OPTIONS
-    context['page_list'] = page_list
-
-    context['curr_page'] = page
-    context['num_results'] = len(book_list)
-    context['results_per_page'] = BOOKS_PER_PAGE
 
     return render(request, 'rome_templates/book_list.html', context)
 
@@ -95,12 +126,7 @@ def book_detail(request, book_id):
     context['back_to_book_href'] = u'%s?page=%s' % (reverse('books'), book_list_page)
     context['book'] = Book.get_or_404(pid="%s:%s" % (PID_PREFIX, book_id))
     context['breadcrumbs'][-1]['name'] = breadcrumb_detail(context)
-    grp = 20 # group size for lookups
-    pages = context['book'].pages()
-    pid_groups = [["%s:%s" % (PID_PREFIX, x.id) for x in pages[i:i+grp]] for i in range(0, len(pages), grp)]
-    url = "https://%s/api/search?q=%s+AND+display:BDR_PUBLIC&fl=rel_is_annotation_of_ssim&rows=6000&callback=mark_annotated"
-    annot_lookups = [url % (BDR_SERVER, "rel_is_annotation_of_ssim:(\"" + ("\"+OR+\"".join(l)) + "\")") for l in pid_groups]
-    context['annot_lookups'] = annot_lookups
+    context['annotated_page_ids'] = context['book'].annotated_page_ids()
     return render(request, 'rome_templates/book_detail.html', context)
 
 
@@ -110,11 +136,19 @@ def page_detail(request, page_id, book_id=None):
     context=std_context(request.path, )
     if book_id:
         book_pid = '%s:%s' % (PID_PREFIX, book_id)
+        # the book & the page are independent, so fetch them at the same time
+        (book_json, book_error), (page_json, page_error) = map_with_deadline(get_item, [book_pid, page_pid], ITEM_FETCH_DEADLINE)
+        for pid, error in ((book_pid, book_error), (page_pid, page_error)):
+            if error:
+                logger.error(u'TTWR - error retrieving %s: %s' % (pid, error))
     else:
+        # the page says which book it's in (get_item caches it, so it's only fetched once)
         book_pid = _get_book_pid_from_page_pid(u'%s' % page_pid)
+        if not book_pid:
+            return HttpResponseNotFound('Book for this page not found.')
         book_id = book_pid.split(':')[-1]
-    if not book_id:
-        return HttpResponseNotFound('Book for this page not found.')
+        book_json = get_item(book_pid)
+        page_json = get_item(page_pid)
 
     context['user'] = request.user
     if request.user.is_authenticated():
@@ -136,13 +170,8 @@ def page_detail(request, page_id, book_id=None):
     context['book_id'] = book_id
 
     thumbnails=[]
-    book_json_uri = u'https://%s/api/items/%s/' % (BDR_SERVER, book_pid)
-    r = requests.get(book_json_uri, timeout=60)
-    if not r.ok:
-        logger.error(u'TTWR - error retrieving url %s' % book_json_uri)
-        logger.error(u'TTWR - response: %s - %s' % (r.status_code, r.text))
+    if book_json is None:
         return HttpResponseServerError('Error retrieving content.')
-    book_json = json.loads(r.text)
     context['short_title']=book_json['brief']['title']
     context['title'] = _get_full_title(book_json)
     try:
@@ -169,54 +198,31 @@ def page_detail(request, page_id, book_id=None):
     context['breadcrumbs'][-2]['name'] = breadcrumb_detail(context, view="print")
 
     # annotations/metadata
-    page_json_uri = u'https://%s/api/items/%s/' % (BDR_SERVER, page_pid)
-    r = requests.get(page_json_uri, timeout=60)
-    if not r.ok:
-        logger.error(u'TTWR - error retrieving url %s' % page_json_uri)
-        logger.error(u'TTWR - response: %s - %s' % (r.status_code, r.text))
+    if page_json is None:
         return HttpResponseServerError('Error retrieving content.')
-    page_json = json.loads(r.text)
     annotations=page_json['relations']['hasAnnotation']
     context['has_annotations']=len(annotations)
     context['annotation_uris']=[]
-    context['annotations']=[]
+    annotation_list=[]
     for annotation in annotations:
+        annotation = dict(annotation) #the item json is cached - don't modify it
         anno_id = annotation['pid'].split(':')[-1]
         if request.user.is_authenticated():
             link = reverse('edit_annotation', kwargs={'book_id': book_id, 'page_id': page_id, 'anno_id': anno_id})
             annotation['edit_link'] = link
-        annot_xml_uri='https://%s/services/getMods/%s/' % (BDR_SERVER, annotation['pid'])
+        annot_xml_uri = bdr_client.mods_url(annotation['pid'])
         context['annotation_uris'].append(annot_xml_uri)
         annotation['xml_uri'] = annot_xml_uri
-        curr_annot = get_annotation_detail(annotation)
-        context['annotations'].append(curr_annot)
+        annotation_list.append(annotation)
+    context['annotations'] = get_annotation_details(annotation_list)
+    context['unfinished_writes'] = outbox.unfinished_for(page_pid)
     if(context['annotations']):
         context['annotations'] = sorted(context['annotations'], key=lambda annote: annotation_order(annote))
 
-    # Previous/next page links
-    # First, find the index of the page we're currently loading
-    hasPart_index = 0
-    for page in book_json['relations']['hasPart']:
-        if page['pid'] == page_pid:
-            hasPart_index = int(page['order']) - 1
-
-    # Initialize both the next page and previous page
-    prev_pid = book_json['relations']['hasPart'][hasPart_index - 1]['pid'].split(":")[-1]
-    next_pid = "none"
-    try:
-        next_pid = book_json['relations']['hasPart'][hasPart_index + 1]['pid'].split(":")[-1]
-    except (KeyError,IndexError) as e:
-        # If it's the last page in the book, there is no next pid
-        next_pid = "none"
-
-    # If it's the first page in the book
-    if hasPart_index == 0:
-        prev_pid == "none"
-
-    # assert(prev_pid != next_pid)
-
-    context['prev_pid'] = prev_pid
-    context['next_pid'] = next_pid
+    # Previous/next page links, from the book's cached page order
+    (order, prev_pid, next_pid) = page_order_index(book_pid, book_json).get(page_pid, (None, None, None))
+    context['prev_pid'] = prev_pid.split(":")[-1] if prev_pid else "none"
+    context['next_pid'] = next_pid.split(":")[-1] if next_pid else "none"
 
     context['breadcrumbs'][-1]['name'] = "Image " + page_json['rel_has_pagination_ssim'][0]
 
@@ -224,97 +230,132 @@ def page_detail(request, page_id, book_id=None):
     return HttpResponse(template.render(c))
 
 
+def get_annotation_details(annotations):
+    # fetch all the annotations in parallel; one that fails or takes too long
+    # is shown as unavailable instead of failing the whole page
+    details = []
+    results = map_with_deadline(get_annotation_detail, annotations, ANNOTATION_FETCH_DEADLINE)
+    for annotation, (curr_annot, error) in zip(annotations, results):
+        if error:
+            logger.error(u'TTWR - error loading annotation %s: %s' % (annotation['pid'], error))
+            curr_annot = {'pid': annotation['pid'], 'xml_uri': annotation['xml_uri'], 'error': True, 'has_elements': {}}
+        details.append(curr_annot)
+    #everyone named on the page in one lookup, so names only link to people we have a biography for
+    people = resolve_vocabulary(trp_ids=[n['trp_id'] for d in details for n in d.get('names', [])])['person']
+    for curr_annot in details:
+        for name in curr_annot.get('names', []):
+            name['has_bio'] = name['trp_id'] in people
+    return details
+
+
 def get_annotation_detail(annotation):
-    curr_annot={}
+    curr_annot = get_annotation_record(annotation['pid'])
     curr_annot['xml_uri'] = annotation['xml_uri']
     if 'edit_link' in annotation:
         curr_annot['edit_link'] = annotation['edit_link']
-    curr_annot['has_elements'] = {'inscriptions':0, 'annotations':0, 'annotator':0, 'origin':0, 'title':0, 'abstract':0, 'genre':0}
+    return curr_annot
 
-    root = ET.fromstring(requests.get(curr_annot['xml_uri']).content)
-    for title in root.getiterator('{http://www.loc.gov/mods/v3}titleInfo'):
-        try:
-            if title.attrib['lang']=='en':
-                curr_annot['title']=title[0].text
-            else:
-                curr_annot['orig_title']=title[0].text
-        except KeyError:
-            curr_annot['orig_title'] = title[0].text
-        curr_annot['has_elements']['title'] += 1
-
-    curr_annot['names']=[]
-    for name in root.getiterator('{http://www.loc.gov/mods/v3}name'):
-        curr_annot['names'].append({
-            'name':name[0].text,
-            'role':name[1][0].text.capitalize() if(name[1][0].text) else "Contributor",
-            'trp_id': "%04d" % int(name.attrib['{http://www.w3.org/1999/xlink}href']),
-        })
-        curr_annot['names'] = sorted(curr_annot['names'], key=itemgetter("role", "name"))
-    for abstract in root.getiterator('{http://www.loc.gov/mods/v3}abstract'):
-        curr_annot['abstract']=abstract.text
-        curr_annot['has_elements']['abstract']=1
-    for genre in root.getiterator('{http://www.loc.gov/mods/v3}genre'):
-        curr_annot['genre'] = genre.text
-        curr_annot['has_elements']['genre']=1
-    for origin in root.getiterator('{http://www.loc.gov/mods/v3}originInfo'):
-        try:
-            for impression in origin.getiterator("{http://www.loc.gov/mods/v3}dateOther"):
-                try:
-                    curr_annot['impression']=impression.text
-                    if(impression.text != None):
-                        curr_annot['has_elements']['impression']=1
-                except:
-                    pass
 
-            curr_annot['origin']=origin[0].date
-            curr_annot['has_elements']['origin']=1
+def get_annotation_record(pid):
+    # the parsed record only depends on the MODS, so it's cached by annotation pid
+    # (as compact json, so it's safe to hand out & works with any cache backend)
+    cached = annotation_cache.get(pid)
+    if cached is not None:
+        return json.loads(cached)
+    mirrored = get_mirrored_annotation_record(pid)
+    if mirrored is not None:
+        return mirrored
+    r = bdr_client.get_mods(pid)
+    if not r.ok:
+        raise Exception('error retrieving annotation %s: %s' % (pid, r.status_code))
+    return cache_annotation_record(pid, r.content)
 
-        except:
-            pass
-    for impression in root.getiterator('{http://www.loc.gov/mods/v3}dateOther'):
-        try:
-            if impression.attrib['type'] == "impression":
-                curr_annot['impression']=impression[0].text
-                curr_annot['has_elements']['impression']=1
-        except:
-            pass
-    curr_annot['inscriptions'] = []
-    curr_annot['annotations'] = []
-    curr_annot['annotator'] = ""
-    for note in root.getiterator('{http://www.loc.gov/mods/v3}note'):
-        curr_note={}
-        for att in note.attrib:
-            curr_note[att]=note.attrib[att]
-        if note.text:
-            curr_note['text']=note.text
-        if curr_note['type'].lower()=='inscription' and note.text:
-            curr_annot['inscriptions'].append(curr_note['displayLabel']+": "+curr_note['text'])
-            curr_annot['has_elements']['inscriptions']=1
-        elif curr_note['type'].lower()=='annotation' and note.text:
-            curr_annot['annotations'].append(curr_note['displayLabel']+": "+curr_note['text'])
-            curr_annot['has_elements']['annotations']=1
-        elif curr_note['type'].lower()=='resp' and note.text:
-            #display for the first annotator; ignore later annotators for now
-            if not curr_annot['annotator']:
-                curr_annot['annotator'] = note.text
-                curr_annot['has_elements']['annotator'] = 1
+
+def cache_annotation_record(pid, mods_xml):
+    curr_annot = parse_annotation(mods_xml)
+    annotation_cache.set(pid, json.dumps(curr_annot, separators=(',', ':')))
     return curr_annot
 
 
+def _print_sort_key(sort_by):
+    fields = (sort_by, 'authors', 'title', 'date')
+    def key(entry):
+        record = entry[1]
+        #sort titles without their nonsort article
+        values = {
+            'title': collation_key(record.primary_title),
+            'authors': collation_key(record.authors),
+            'date': record.date,
+        }
+        return tuple(values[field] for field in fields)
+    return key
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def _print_facets(entry):
+    print_data, record = entry
+    year = record.date
+    return {
+        'chinea': ['chinea' if record.in_chinea else 'not'],
+        'genre': _as_list(print_data.get('genre_aat')),
+        'contributor': _as_list(print_data.get('contributor') or print_data.get('contributor_display')),
+        'decade': [u'%s0s' % year[:3] if year[:4].isdigit() else u'n.d.'],
+    }
+
+def _print_entries(prints_set):
+    #each print's record is made once, and the sort keys & facets work from it
+    for print_data in prints_set:
+        yield print_data, PrintRecord(print_data, _in_chinea(print_data))
+
+
+def _sorted_prints():
+    #every print, in each Page.SORT_OPTIONS order, with a facet index for filtering
+    def build():
+        prints_set = Print.mirror_search(Print.LIST_QUERY, Print.LIST_FIELDS)
+        if prints_set is None:
+            #streamed, and never kept whole: the collection only keeps a PrintRecord per print
+            prints_set = bdr_client.iter_docs(bdr_client.search_url(), {'q': Print.LIST_QUERY}, fields=Print.LIST_FIELDS)
+        prints_set = (Print._from_doc(print_data, Print.LIST_FIELDS).data for print_data in prints_set) #checks fields in DEBUG_PROJECTION mode
+        sort_keys = dict((opt, _print_sort_key(opt)) for opt in Page.SORT_OPTIONS.values())
+        return SortedCollection(_print_entries(prints_set), sort_keys, record=itemgetter(1), facets=_print_facets)
+    return get_sorted('prints', build)
+
+
+PRINT_FACETS = (('genre', 'Genre'), ('decade', 'Decade'), ('contributor', 'Contributor'))
+FACET_LIMIT = 25 #values listed per facet (chosen ones are always listed)
+
+def _facet_links(request, counts):
+    facets = []
+    for facet, label in PRINT_FACETS:
+        chosen = request.GET.getlist(facet)
+        values = []
+        for i, (value, count) in enumerate(counts.get(facet, [])):
+            active = value in chosen
+            if i >= FACET_LIMIT and not active:
+                continue
+            params = request.GET.copy()
+            for name in ('page', 'fragment'):
+                params.pop(name, None)
+            params.setlist(facet, [v for v in chosen if v != value] if active else chosen + [value])
+            values.append({'value': value, 'count': count, 'active': active, 'href': u'?%s' % params.urlencode()})
+        if values:
+            facets.append({'name': facet, 'label': label, 'values': values})
+    return facets
+
+
 def print_list(request):
     template=loader.get_template('rome_templates/print_list.html')
-    page = request.GET.get('page', 1)
     sort_by = request.GET.get('sort_by', 'title')
+    if sort_by not in Page.SORT_OPTIONS.values():
+        sort_by = 'title'
     collection = request.GET.get('filter', 'both')
-    chinea = ""
-    if(collection == 'chinea'):
-        chinea = "+AND+(primary_title:\"Chinea\"+OR+subtitle:\"Chinea\")"
-    elif(collection == 'not'):
-        chinea = "+NOT+primary_title:\"Chinea\"+NOT+subtitle:\"Chinea\""
 
     context=std_context(request.path, title="The Theater that was Rome - Prints")
     context['page_documentation']='Browse the prints in the Theater that was Rome collection. Click on "View" to explore a print further.'
-    context['curr_page']=page
     context['sorting']='authors'
     if sort_by!='authors':
         context['sorting']=sort_by
@@ -323,82 +364,28 @@ def print_list(request):
     context['sort_options'] = Page.SORT_OPTIONS
     context['filter_options'] = {"chinea": "chinea", "Non-Chinea": "not", "Both": "both"}
 
-    # load json for all prints in the collection #
-    num_prints_estimate = 6000
-
-    url1 = 'https://%s/api/search/?q=ir_collection_id:621+AND+(genre_aat:"etchings (prints)"+OR+genre_aat:"engravings (prints)")%s&rows=%s' % (BDR_SERVER, chinea, num_prints_estimate)
-    prints_json = json.loads(requests.get(url1).text)
-    num_prints = prints_json['response']['numFound']
-    context['num_results'] = num_prints
-    prints_set = prints_json['response']['docs']
-
-    print_list=[]
-    for i in range(len(prints_set)): #create list of prints to load
-        current_print={}
-        Print=prints_set[i]
-        title = _get_full_title(Print)
-        current_print['in_chinea']=0
-        if collection == "chinea":
-            current_print['in_chinea']=1
-        elif (re.search(r"chinea",title,re.IGNORECASE) or (re.search(r"chinea",Print[u'subtitle'][0],re.IGNORECASE) if u'subtitle' in Print else False)):
-            current_print['in_chinea']=1
-        pid=Print['pid']
-        current_print['studio_uri']= 'https://%s/studio/item/%s/' % (BDR_SERVER, pid)
-        short_title=title
-        current_print['title_cut']=0
-        current_print['thumbnail_url'] = reverse('specific_print', args=[pid.split(":")[1]])
-        if len(title)>60:
-            short_title=title[0:57]+"..."
-            current_print['title_cut']=1
-        current_print['title']=title
-        current_print['short_title']=short_title
-        current_print['det_img_viewer']='https://%s/viewers/image/zoom/%s' % (BDR_SERVER, pid)
-        try:
-            current_print['date']=Print['dateCreated'][0:4]
-        except:
-            try:
-                current_print['date']=Print['dateIssued'][0:4]
-            except:
-                current_print['date']="n.d."
-        try:
-            author_list=Print['contributor_display']
-        except KeyError:
-            try:
-                author_list=Print['contributor']
-            except:
-                author_list=["Unknown"];
-        authors=""
-        for i in range(len(author_list)):
-            if i==len(author_list)-1:
-                authors+=author_list[i]
-            else:
-                authors+=author_list[i]+"; "
-        current_print['authors']=authors
-        current_print['id']=pid.split(":")[1]
-        print_list.append(current_print)
-
-
-    print_list=sorted(print_list,key=itemgetter(sort_by,'authors','title','date'))
-    for i, Print in enumerate(print_list):
-        Print['number_in_list']=i+1
-    context['print_list']=print_list
+    # filter with the facet index - any combination, without asking the BDR again
+    prints = _sorted_prints()
+    selected = dict((facet, request.GET.getlist(facet)) for facet, label in PRINT_FACETS if request.GET.getlist(facet))
+    if collection in ('chinea', 'not'):
+        selected['chinea'] = [collection]
+    mask = prints.facet_index.select(selected) if selected else None
+    print_list = prints.sorted_view(sort_by, mask=mask)
+    context['facets'] = _facet_links(request, prints.facet_index.counts(selected))
 
     prints_per_page=20
-    context['results_per_page']=prints_per_page
-    PAGIN=Paginator(print_list,prints_per_page) #20 prints per page
-    context['num_pages']=PAGIN.num_pages
-    context['page_range']=PAGIN.page_range
-    context['PAGIN']=PAGIN
-    page_list=[]
-    for i in PAGIN.page_range:
-        page_list.append(PAGIN.page(i).object_list)
-    context['page_list']=page_list
+    _paginate(request, print_list, prints_per_page, context, label=attrgetter(sort_by))
     context['filter']=collection
 
     c=RequestContext(request,context)
     return HttpResponse(template.render(c))
 
 
+def _in_chinea(print_data):
+    title = _get_full_title(print_data)
+    return bool(re.search(r"chinea",title,re.IGNORECASE) or (re.search(r"chinea",print_data[u'subtitle'][0],re.IGNORECASE) if u'subtitle' in print_data else False))
+
+
 def print_detail(request, print_id):
     print_pid = '%s:%s' % (PID_PREFIX, print_id)
     template = loader.get_template('rome_templates/page_detail.html')
@@ -421,8 +408,9 @@ def print_detail(request, print_id):
     context['print_id'] = print_id
     context['studio_url'] = 'https://%s/studio/item/%s/' % (BDR_SERVER, print_pid)
 
-    json_uri = 'https://%s/api/items/%s/' % (BDR_SERVER, print_pid)
-    print_json = json.loads(requests.get(json_uri).text)
+    print_json = get_item(print_pid)
+    if print_json is None:
+        return HttpResponseServerError('Error retrieving content.')
     context['short_title'] = print_json['brief']['title']
     context['title'] = _get_full_title(print_json)
     try:
@@ -448,17 +436,19 @@ def print_detail(request, print_id):
     annotations=print_json['relations']['hasAnnotation']
     context['has_annotations']=len(annotations)
     context['annotation_uris']=[]
-    context['annotations']=[]
+    annotation_list=[]
     for annotation in annotations:
-        annot_xml_uri='https://%s/services/getMods/%s/' % (BDR_SERVER, annotation['pid'])
+        annotation = dict(annotation) #the item json is cached - don't modify it
+        annot_xml_uri = bdr_client.mods_url(annotation['pid'])
         context['annotation_uris'].append(annot_xml_uri)
         annotation['xml_uri'] = annot_xml_uri
         anno_id = annotation['pid'].split(':')[-1]
         if request.user.is_authenticated():
             link = reverse('edit_print_annotation', kwargs={'print_id': print_id, 'anno_id': anno_id})
             annotation['edit_link'] = link
-        curr_annot = get_annotation_detail(annotation)
-        context['annotations'].append(curr_annot)
+        annotation_list.append(annotation)
+    context['annotations'] = get_annotation_details(annotation_list)
+    context['unfinished_writes'] = outbox.unfinished_for(print_pid)
 
 
     context['breadcrumbs'][-1]['name'] = breadcrumb_detail(context, view="print")
@@ -479,41 +469,45 @@ def biography_detail(request, trp_id):
     template = loader.get_template('rome_templates/biography_detail.html')
     context['bio'] = bio
     context['trp_id'] = trp_id
-    context['books'] = bio.books()
-    prints_search = bio.prints()
-
-    # Pages related to the person by annotation
-    (pages_books, prints_mentioned) = bio.annotations_by_books_and_prints()
+    # books, prints & pages related to the person (by annotation) - see PersonWorksIndex
+    (books, prints, pages_books) = PersonWorksIndex.works_for(bio)
+    context['books'] = books
     context['pages_books'] = pages_books
-    # merge the two lists of prints
-    prints_merged = [x for x in prints_mentioned if x not in prints_search]
-    prints_merged[len(prints_merged):] = prints_search
-
-    context['prints'] = prints_merged
+    context['prints'] = prints
 
     context['breadcrumbs'][-1]['name'] = breadcrumb_detail(context, view="bio")
     return HttpResponse(template.render(context))
 
 def person_detail_tei(request, trp_id):
-    pid, name = _get_info_from_trp_id(trp_id)
-    if not pid:
-        return HttpResponseNotFound('Not Found')
-    r = requests.get(u'https://%s/fedora/objects/%s/datastreams/TEI/content' % (BDR_SERVER, pid))
-    if r.ok:
-        return HttpResponse(r.text)
-    else:
+    # served from the on-disk cache (see tei.py), with our own ETag/Last-Modified for conditional GETs
+    trp_id = '%04d' % int(trp_id)
+    try:
+        entry = tei.get_entry(trp_id)
+        if not entry or not tei.refresh(entry):
+            return HttpResponseNotFound('Not Found')
+        f = open(tei.path_for(entry), 'rb')
+    except Exception as e:
+        logger.error(u'TTWR - error serving TEI for %s: %s' % (trp_id, e))
         return HttpResponseServerError('Internal Server error')
+    stat = os.fstat(f.fileno())
+    etag = '"%s"' % entry.etag
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_none_match:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    else:
+        not_modified = bool(if_modified_since) and if_modified_since >= int(stat.st_mtime)
+    if not_modified:
+        f.close()
+        response = HttpResponseNotModified()
+    else:
+        response = StreamingHttpResponse(FileWrapper(f), content_type=entry.content_type)
+        response['Content-Length'] = str(stat.st_size)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    return response
 
 
-def _get_info_from_trp_id(trp_id):
-    trp_id = u'trp-%04d' % int(trp_id)
-    r = requests.get(u'http://%s/api/search?q=mods_id_trp_ssim:%s+AND+display:BDR_PUBLIC&fl=pid,name' % (BDR_SERVER, trp_id))
-    if r.ok:
-        data = json.loads(r.text)
-        if data['response']['numFound'] > 0:
-            return (data['response']['docs'][0]['pid'], data['response']['docs'][0]['name'])
-    return None, None
-
 def _get_full_title(data):
     if 'primary_title' not in data:
         return 'No Title'
@@ -527,53 +521,35 @@ def _get_full_title(data):
 
 
 def _get_book_pid_from_page_pid(page_pid):
-    query = u'https://%s/api/items/%s/' % (BDR_SERVER, page_pid)
-    r = requests.get(query)
-    if r.ok:
-        data = json.loads(r.text)
+    book_pid = PageParent.book_pid_for(page_pid)
+    if book_pid:
+        return book_pid
+    data = get_item(page_pid)
+    if data:
         if data['relations']['isPartOf']:
-            return data['relations']['isPartOf'][0]['pid']
+            book_pid = data['relations']['isPartOf'][0]['pid']
         elif data['relations']['isMemberOf']:
-            return data['relations']['isMemberOf'][0]['pid']
+            book_pid = data['relations']['isMemberOf'][0]['pid']
         else:
             return None
-
-def filter_bios(fq, bio_list):
-    return [b for b in bio_list if (b.roles and fq in b.roles)]
+        PageParent.record([(page_pid, book_pid)], quiet=True)
+        return book_pid
 
 def biography_list(request):
     template = loader.get_template('rome_templates/biography_list.html')
     fq = request.GET.get('filter', 'all')
 
+    # filtered, counted & paged in the database; only the page's people (and their roles) are loaded
     bio_list = Biography.objects.all()
-    role_set = set()
-
-    for bio in bio_list:
-        if bio.roles:
-            bio.roles = [role.strip(" ") for role in bio.roles.split(';') if role.strip(" ") != '']
-            role_set |= set(bio.roles)
-
     if fq != 'all':
-        bio_list = filter_bios(fq, bio_list)
+        bio_list = bio_list.filter(role_rows__role=fq).distinct()
+    bio_list = bio_list.prefetch_related('role_rows')
 
     bios_per_page=30
-    PAGIN=Paginator(bio_list,bios_per_page)
-    page_list=[]
-
-    for i in PAGIN.page_range:
-        page_list.append(PAGIN.page(i).object_list)
-
     context=std_context(request.path, title="The Theater that was Rome - Biographies")
     context['page_documentation']='Browse the biographies of artists related to the Theater that was Rome collection.'
-    context['num_results']=len(bio_list)
-    context['bio_list']=bio_list
-    context['results_per_page']=bios_per_page
-    context['num_pages']=PAGIN.num_pages
-    context['page_range']=PAGIN.page_range
-    context['curr_page']=1
-    context['PAGIN']=PAGIN
-    context['page_list']=page_list
-    context['filter_options']= dict([(x, x) for x in sorted(role_set)])
+    _paginate(request, bio_list, bios_per_page, context)
+    context['filter_options']= dict([(x, x) for x in BiographyRole.facet_values()])
     context['filter_options']['all'] = 'all'
     context['filter'] = fq
 
@@ -612,6 +588,7 @@ def essay_detail(request, essay_slug):
     template=loader.get_template('rome_templates/essay_detail.html')
     context=std_context(request.path, style="rome/css/essays.css")
     context['essay_text'] = essay.text
+    context['essay_html'] = essay.text_html
     c=RequestContext(request,context)
     return HttpResponse(template.render(c))
 
@@ -642,8 +619,8 @@ def new_annotation(request, book_id, page_id):
                 annotator = u'%s' % request.user.username
             annotation = Annotation.from_form_data(page_pid, annotator, form.cleaned_data, person_formset.cleaned_data, inscription_formset.cleaned_data)
             try:
-                response = annotation.save_to_bdr()
-                logger.info('%s added annotation %s for %s' % (request.user.username, response['pid'], page_id))
+                #sent to the BDR from the outbox, so the annotator doesn't wait on it
+                outbox.queue_new(annotation, page_pid, request.user.username, book_pid='%s:%s' % (PID_PREFIX, book_id))
                 return HttpResponseRedirect(reverse('book_page_viewer', kwargs={'book_id': book_id, 'page_id': page_id}))
             except Exception as e:
                 logger.error('%s' % e)
@@ -675,8 +652,7 @@ def new_print_annotation(request, print_id):
                 annotator = u'%s' % request.user.username
             annotation = Annotation.from_form_data(print_pid, annotator, form.cleaned_data, person_formset.cleaned_data, inscription_formset.cleaned_data)
             try:
-                response = annotation.save_to_bdr()
-                logger.info('%s added annotation %s for %s' % (request.user.username, response['pid'], print_id))
+                outbox.queue_new(annotation, print_pid, request.user.username)
                 return HttpResponseRedirect(reverse('specific_print', kwargs={'print_id': print_id}))
             except Exception as e:
                 logger.error('%s' % e)
@@ -703,7 +679,7 @@ def edit_annotation_base(request, image_pid, anno_pid, redirect_url):
     PersonFormSet = formset_factory(PersonForm)
     InscriptionFormSet = formset_factory(InscriptionForm)
     context_data = {}
-    annotation = Annotation.from_pid(anno_pid)
+    annotation = Annotation.from_pid(anno_pid, image_pid=image_pid, mods_xml=outbox.latest_mods(anno_pid))
     if request.method == 'POST':
         #this part here is similar to posting a new annotation
         form = AnnotationForm(request.POST)
@@ -717,8 +693,7 @@ def edit_annotation_base(request, image_pid, anno_pid, redirect_url):
                 annotator = u'%s' % request.user.username
             annotation.add_form_data(annotator, form.cleaned_data, person_formset.cleaned_data, inscription_formset.cleaned_data)
             try:
-                response = annotation.update_in_bdr()
-                logger.info('%s edited annotation %s' % (request.user.username, anno_pid))
+                outbox.queue_update(annotation, anno_pid, image_pid, request.user.username)
                 return HttpResponseRedirect(redirect_url)
             except Exception as e:
                 logger.error('%s' % e)